@@ -0,0 +1,153 @@
+import socket
+import asyncio
+import threading
+import traceback
+import config
+from client import address_to_target
+
+LISTEN_ADDRESSES = config.CONFIG.get("/client/listenAddresses", ["localhost:20777"])
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol that passes every received datagram through the packet
+    decoder and packet handler, like client.UDPThread does
+    """
+
+    def __init__(self, packet_decoder=None, packet_handler=None, capture=None):
+        self._packet_decoder = packet_decoder
+        self._decoder_takes_source = getattr(packet_decoder, "takes_source", False)
+        self._packet_handler = packet_handler
+        self._capture = capture
+
+    def datagram_received(self, packet, addr):
+        try:
+            if self._capture is not None:
+                self._capture.tap(packet, addr)
+
+            if self._packet_decoder:
+                if self._decoder_takes_source:
+                    packet = self._packet_decoder(packet, source=addr)
+                else:
+                    packet = self._packet_decoder(packet)
+                if packet is None:
+                    return
+
+            if self._packet_handler:
+                self._packet_handler(packet)
+
+        except Exception as err:
+            print("UDPProtocol Error:", err)
+            traceback.print_exc()
+
+    def error_received(self, exc):
+        print("UDPProtocol Error:", exc)
+
+
+class AsyncUDPReceiver:
+    """
+    Receives udp packets on an asyncio event loop, so ingest can be combined
+    with other asynchronous work in the same loop. Listens on any number of
+    addresses. Packets are handled like in client.UDPThread:
+        packet_decoder: the raw binary data packet is passed to this function and then
+                    replaced by its return value. If the decoder returns None, the
+                    packet is dropped.
+        packet_handler: the decoded packet is passed to the packet handler
+    """
+
+    def __init__(self, addresses=None, packet_decoder=None, packet_handler=None, receive_buffer_size=0,
+            capture=None):
+        """
+        Initializes the receiver.
+            addresses: list of (address, port) tuples to listen on
+                        If not provided: /client/listenAddresses from the config
+
+            packet_decoder, packet_handler: see client.UDPThread
+
+            receive_buffer_size: size of the kernel receive buffers (SO_RCVBUF) in bytes
+                        If not provided: use the system default
+
+            capture: a capture.CaptureWriter. If provided, the datagrams received on
+                        all addresses are recorded before they are decoded
+        """
+
+        if addresses is None:
+            addresses = [address_to_target(address) for address in LISTEN_ADDRESSES]
+        self._addresses = addresses
+        self._packet_decoder = packet_decoder
+        self._packet_handler = packet_handler
+        self._receive_buffer_size = receive_buffer_size
+        self._capture = capture
+        self._transports = []
+        self._stopped = None
+
+    async def start(self):
+        """
+        Binds all sockets and begins receiving packets on the running event loop
+        """
+
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        protocol = UDPProtocol(self._packet_decoder, self._packet_handler, self._capture)
+        for address in self._addresses:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._receive_buffer_size > 0:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._receive_buffer_size)
+            sock.bind(address)
+            transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+            self._transports.append(transport)
+
+    def stop(self):
+        """
+        Closes all sockets. Returns immediately, no packets are handled afterwards
+        """
+
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def serve(self):
+        """
+        Starts receiving and waits until stop is called
+        """
+
+        await self.start()
+        await self._stopped.wait()
+
+
+class AsyncReceiverThread:
+    """
+    Runs an AsyncUDPReceiver on an event loop in its own thread, so it can be used
+    like client.UDPThread by synchronous code
+    """
+
+    def __init__(self, receiver):
+        self._receiver = receiver
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._receiver.serve())
+        except Exception as err:
+            print("AsyncReceiverThread Error:", err)
+            traceback.print_exc()
+        finally:
+            self._loop.close()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the receiver and waits for the thread to end
+        """
+
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._receiver.stop)
+        self._thread.join()
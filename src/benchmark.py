@@ -0,0 +1,355 @@
+import sys
+import json
+import time
+import random
+import socket
+import tracemalloc
+import config
+import replay
+import capture
+import udp_broker
+import f1.f1decode as f1decode
+import f1.f1session as f1session
+import f1.f1structs as f1structs
+from f1.f1enums import PacketIDs, EventCodes
+
+PACKETS_PER_TYPE = config.CONFIG.get("/benchmark/packetsPerType", 1000)
+ALLOCATION_SAMPLES = config.CONFIG.get("/benchmark/allocationSamples", 500)
+BASELINE_FILE = config.CONFIG.get("/benchmark/baselineFile", "benchmark_baseline.json")
+REGRESSION_THRESHOLD = config.CONFIG.get("/benchmark/regressionThreshold", 0.2)
+BROKER_TARGET_COUNTS = config.CONFIG.get("/benchmark/brokerTargetCounts", [1, 4])
+BROKER_BATCH_SIZE = config.CONFIG.get("/benchmark/brokerBatchSize", 64)
+REPLAY_CAPTURE = config.CONFIG.get("/benchmark/replayCapture")
+
+SESSION_UID = 0x1F2020
+EVENT_CODES = [value for key, value in vars(EventCodes).items() if not key.startswith("_")]
+
+
+def synthetic_values(fields, rng, tables=f1structs) -> list:
+    """
+    Generates random but plausible values for a list of (datatype, name) fields
+    as they are defined in f1structs. The values are returned as a flat list in
+    the order in which they are packed (see f1decode.StructCodec)
+    """
+
+    values = []
+    for datatype, name in fields:
+        base_type, n = datatype, 1
+        if "*" in datatype:
+            base_type, n = datatype.split("*")[0], int(datatype.split("*")[1])
+
+        if base_type == "char":
+            if name == "m_eventStringCode":
+                values.append(rng.choice(EVENT_CODES).encode())
+            else:
+                values.append(("Driver %02d" % rng.randint(0, 99)).encode())
+            continue
+
+        for i in range(n):
+            if base_type.startswith("struct"):
+                values += synthetic_values(getattr(tables, base_type), rng, tables)
+            elif base_type == "uint8":
+                # Small values keep car indices and enum values valid
+                values.append(rng.randint(0, 21))
+            elif base_type == "int8":
+                values.append(rng.randint(-10, 40))
+            elif base_type in ("float", "double"):
+                values.append(rng.uniform(0.0, 120.0))
+            elif base_type == "int16":
+                values.append(rng.randint(-32767, 32767))
+            else:
+                values.append(rng.randint(0, 5000))
+    return values
+
+
+def synthetic_packet(packet_id: int, frame_id: int, rng, session_uid=SESSION_UID) -> bytes:
+    """
+    Generates a valid datagram for the given packet ID with random content
+    """
+
+    header = [2020, 1, 0, 1, packet_id, session_uid, frame_id / 60.0, frame_id, 0, 255]
+    content = []
+    if packet_id in f1structs.packet_ids:
+        content = synthetic_values(getattr(f1structs, f1structs.packet_ids[packet_id]), rng)
+    return f1decode.get_packet_codec(packet_id).struct.pack(*header, *content)
+
+
+def synthetic_datagrams(packets_per_type: int, seed=2020) -> list:
+    """
+    Generates packets_per_type datagrams for every packet ID in f1structs.packet_ids,
+    interleaved like the game sends them, with increasing frame identifiers
+    """
+
+    rng = random.Random(seed)
+    datagrams = []
+    for frame_id in range(packets_per_type):
+        for packet_id in f1structs.packet_ids.keys():
+            datagrams.append(synthetic_packet(packet_id, frame_id, rng))
+    return datagrams
+
+
+def query_best_lap_data(session) -> None:
+    """
+    Runs the same queries as the main loop in main.py does for one session
+    """
+
+    current_times = session.query(0, PacketIDs.LAP_DATA, "content/m_lapData[+]/m_lastLapTime")
+    session.query(0, PacketIDs.SESSION_DATA, "content/m_trackId")
+    session.query(0, PacketIDs.SESSION_DATA, "content/m_sessionType")
+    for current_time in current_times:
+        car_id = current_time[0]["carIndex"]
+        session.query(car_id, PacketIDs.PARTICIPANTS_DATA, "content/m_participants[@]/m_teamId")
+        session.query(car_id, PacketIDs.CAR_STATUS_DATA, "content/m_carStatusData[@]/m_visualTyreCompound")
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))]
+
+
+def run_stage(setup, items) -> dict:
+    """
+    Measures one stage of the pipeline. setup is called before every pass and
+    returns the function that processes a single item, so that every pass
+    starts with fresh state.
+
+    Returns: a dict with packets per second, latency percentiles in
+    microseconds and the mean number of bytes allocated per packet
+    """
+
+    # Throughput, without any per packet measuring overhead
+    process = setup()
+    start = time.perf_counter()
+    for item in items:
+        process(item)
+    elapsed = time.perf_counter() - start
+
+    # Latency per packet
+    process = setup()
+    latencies = []
+    for item in items:
+        t = time.perf_counter_ns()
+        process(item)
+        latencies.append(time.perf_counter_ns() - t)
+    latencies.sort()
+    if not latencies:
+        latencies = [0]
+
+    # Allocations per packet, measured as the peak of traced memory while
+    # the packet is processed
+    process = setup()
+    samples = items[:ALLOCATION_SAMPLES]
+    allocated = 0
+    tracemalloc.start()
+    for item in samples:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        process(item)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return {
+        "packets": len(items),
+        "packets_per_second": len(items) / elapsed if elapsed > 0 else 0.0,
+        "latency_us": {
+            "p50": percentile(latencies, 50) / 1000.0,
+            "p90": percentile(latencies, 90) / 1000.0,
+            "p99": percentile(latencies, 99) / 1000.0,
+            "max": latencies[-1] / 1000.0,
+        },
+        "allocated_bytes_per_packet": allocated / max(1, len(samples)),
+    }
+
+
+def run_fanout_stage(datagrams: list, target_count: int, batch_size: int) -> dict:
+    """
+    Measures the forwarding ceiling of udp_broker.FanoutEngine over localhost. The
+    datagrams are sent to the engine in batches, every batch is received and sent
+    to target_count sink sockets, which are never read (the kernel drops what does
+    not fit into their buffers). Only the time spent in the engine is measured.
+
+    Returns: a dict like run_stage, latencies are the batch times divided by the
+    number of datagrams in the batch
+    """
+
+    feeder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    in_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    in_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4194304)
+    in_socket.bind(("127.0.0.1", 0))
+    sinks = []
+    for i in range(target_count):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sinks.append(sink)
+
+    targets = [udp_broker.BrokerTarget(sink.getsockname()) for sink in sinks]
+    engine = udp_broker.FanoutEngine(in_socket, targets, batch_size)
+    in_address = in_socket.getsockname()
+    batches = [datagrams[i:i + batch_size] for i in range(0, len(datagrams), batch_size)]
+
+    def forward(batch, tracing=False):
+        for datagram in batch:
+            feeder.sendto(datagram, in_address)
+        if tracing:
+            tracemalloc.start()
+        t = time.perf_counter_ns()
+        received = engine.receive_batch()
+        engine.send_batch(received)
+        batch_time = time.perf_counter_ns() - t
+        allocated = 0
+        if tracing:
+            allocated = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return len(received), batch_time, allocated
+
+    # Throughput and latency, every batch is timed
+    elapsed = 0
+    forwarded = 0
+    latencies = []
+    for batch in batches:
+        count, batch_time, _ = forward(batch)
+        elapsed += batch_time
+        forwarded += count
+        if count > 0:
+            latencies.append(batch_time / count)
+
+    # Allocations per packet in a separate pass, so tracing does not slow down
+    # the timed batches
+    allocated = 0
+    allocation_samples = 0
+    for batch in batches:
+        if allocation_samples >= ALLOCATION_SAMPLES:
+            break
+        count, _, batch_allocated = forward(batch, tracing=True)
+        allocated += batch_allocated
+        allocation_samples += count
+
+    engine.close()
+    for sock in [feeder, in_socket] + sinks:
+        sock.close()
+    latencies.sort()
+    if not latencies:
+        latencies = [0]
+
+    return {
+        "packets": forwarded,
+        "packets_per_second": forwarded / (elapsed / 1e9) if elapsed > 0 else 0.0,
+        "latency_us": {
+            "p50": percentile(latencies, 50) / 1000.0,
+            "p90": percentile(latencies, 90) / 1000.0,
+            "p99": percentile(latencies, 99) / 1000.0,
+            "max": latencies[-1] / 1000.0,
+        },
+        "allocated_bytes_per_packet": allocated / max(1, allocation_samples),
+    }
+
+
+def run_benchmarks(packets_per_type: int) -> dict:
+    """
+    Runs all benchmark stages on synthetic datagrams
+
+    Returns: a dict that maps stage names to their results
+    """
+
+    datagrams = synthetic_datagrams(packets_per_type)
+    decoded = [f1decode.decode_packet(datagram) for datagram in datagrams]
+    results = {}
+
+    # Decoding, per packet type and for all packet types
+    for packet_id in f1structs.packet_ids.keys():
+        packet_datagrams = [d for d, p in zip(datagrams, decoded) if p["header"]["m_packetId"] == packet_id]
+        results["decode_packet/%d" % packet_id] = run_stage(lambda: f1decode.decode_packet, packet_datagrams)
+    results["decode_packet"] = run_stage(lambda: f1decode.decode_packet, datagrams)
+
+    # Dispatching already decoded packets
+    results["dispatch_packet"] = run_stage(
+        lambda: f1session.F1SessionManager().dispatch_packet, decoded)
+
+    # Querying a session that holds packets of every type (there is none without
+    # datagrams)
+    manager = f1session.F1SessionManager()
+    for packet in decoded:
+        manager.dispatch_packet(packet)
+    if SESSION_UID in manager.sessions:
+        session = manager.sessions[SESSION_UID]
+        results["query"] = run_stage(
+            lambda: (lambda i: query_best_lap_data(session)), list(range(len(decoded))))
+
+    # End to end: decode, dispatch and run the main loop queries whenever
+    # new lap data arrives
+    def setup_pipeline():
+        manager = f1session.F1SessionManager()
+        def process(datagram):
+            packet = f1decode.decode_packet(datagram)
+            manager.dispatch_packet(packet)
+            if packet["header"]["m_packetId"] == PacketIDs.LAP_DATA:
+                session = manager.sessions[SESSION_UID]
+                if session.has_best_lap_data():
+                    query_best_lap_data(session)
+        return process
+    results["end_to_end"] = run_stage(setup_pipeline, datagrams)
+
+    # Forwarding through the broker, packets/s are datagrams received per second
+    for target_count in BROKER_TARGET_COUNTS:
+        results["broker_fanout/%d" % target_count] = run_fanout_stage(
+            datagrams, target_count, BROKER_BATCH_SIZE)
+
+    # Replaying a recorded capture through the pipeline of main.py
+    if REPLAY_CAPTURE:
+        records = list(capture.read_capture(REPLAY_CAPTURE))
+        results["replay"] = run_stage(lambda: replay.BestLapReplay().process, records)
+
+    return results
+
+
+def compare_to_baseline(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compares results to a saved baseline.
+
+    Returns: a list of (stage, baseline packets/s, current packets/s) for every
+    stage whose throughput dropped by more than threshold
+    """
+
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        baseline_rate = baseline[stage]["packets_per_second"]
+        if result["packets_per_second"] < baseline_rate * (1.0 - threshold):
+            regressions.append((stage, baseline_rate, result["packets_per_second"]))
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    print("%-20s %12s %9s %9s %9s %9s %12s" % (
+        "stage", "packets/s", "p50 us", "p90 us", "p99 us", "max us", "bytes/packet"))
+    for stage, result in results.items():
+        latency = result["latency_us"]
+        print("%-20s %12.0f %9.1f %9.1f %9.1f %9.1f %12.0f" % (
+            stage, result["packets_per_second"], latency["p50"], latency["p90"],
+            latency["p99"], latency["max"], result["allocated_bytes_per_packet"]))
+
+
+if __name__ == "__main__":
+    # Usage: benchmark.py [--save-baseline]
+    # Without a saved baseline, the results are saved as the new baseline
+    results = run_benchmarks(PACKETS_PER_TYPE)
+    print_results(results)
+
+    try:
+        with open(BASELINE_FILE, "r") as baseline_file:
+            baseline = json.loads(baseline_file.read())
+    except IOError:
+        baseline = None
+
+    if baseline is None or "--save-baseline" in sys.argv:
+        with open(BASELINE_FILE, "w") as baseline_file:
+            baseline_file.write(json.dumps(results, indent=4))
+        print("Saved baseline to '%s'" % BASELINE_FILE)
+        exit(0)
+
+    regressions = compare_to_baseline(results, baseline, REGRESSION_THRESHOLD)
+    for stage, baseline_rate, rate in regressions:
+        print("Regression in '%s': %.0f packets/s (baseline: %.0f packets/s)" % (stage, rate, baseline_rate))
+    if regressions:
+        exit(1)
+    print("No regressions against baseline '%s'" % BASELINE_FILE)
@@ -0,0 +1,143 @@
+import f1.f1decode as f1decode
+import f1.f1session as f1session
+from f1.f1enums import PacketIDs
+
+
+def create_packet_decoder(lazy=True):
+    """
+    Creates the packet decoder pipeline for best lap times. Only packets that are
+    needed for best lap times are decoded, all others are dropped. Contents of slowly
+    changing packets like participants are only decoded when they change. Packets of
+    unsupported game versions are rejected after reading the header.
+
+    Returns: a tuple of the format registry (the decoder to use), the selective decoder
+    and the memo decoder
+    """
+
+    memo_decoder = f1decode.MemoDecoder(f1decode.decode_packet_lazy if lazy else f1decode.decode_packet)
+    packet_decoder = f1decode.SelectiveDecoder(memo_decoder)
+    packet_decoder.subscribe(*f1session.F1Session.BEST_LAP_PACKET_IDS)
+    # Events announce fastest laps and session ends as soon as they happen
+    packet_decoder.subscribe(PacketIDs.EVENT_DATA)
+    return f1decode.FormatRegistry(packet_decoder), packet_decoder, memo_decoder
+
+
+def create_worker_decoder():
+    """
+    Creates the packet decoder of the decode worker processes (see decode_pool).
+    Lazy packets can't be sent between processes, so packets are decoded entirely.
+    It is defined here so that worker processes can import it without running
+    main.py, whatever the start method of multiprocessing is
+    """
+
+    return create_packet_decoder(lazy=False)[0]
+
+
+def collect_lap_times(session) -> list:
+    """
+    Queries the last lap times of all players in the session.
+
+    Returns: a list of (player_name, lap_time, data) tuples, data is the tuple that is
+    stored in the database: (player_name, track_id, session_type, team_id, tyre_id, lap_time)
+    """
+
+    if not session.has_best_lap_data():
+        return []
+
+    lap_times = []
+    current_times = session.query(0, PacketIDs.LAP_DATA,
+        "content/m_lapData[+]/m_lastLapTime")
+
+    track_id = session.query(0, PacketIDs.SESSION_DATA,
+        "content/m_trackId")
+    session_type = session.query(0, PacketIDs.SESSION_DATA,
+        "content/m_sessionType")
+
+    for current_time in current_times:
+        player_name = current_time[0]["data"]["m_name"]
+        car_id = current_time[0]["carIndex"]
+        lap_time = current_time[1]
+        team_id = session.query(car_id, PacketIDs.PARTICIPANTS_DATA,
+            "content/m_participants[@]/m_teamId")
+        tyre_id = session.query(car_id, PacketIDs.CAR_STATUS_DATA,
+            "content/m_carStatusData[@]/m_visualTyreCompound")
+
+        # If no lap has been completed yet, the last lap time will be 0. Therefore we have
+        # to check for reasonable times
+        if lap_time > 10.0:
+            lap_times.append((player_name, lap_time,
+                (player_name, track_id, session_type, team_id, tyre_id, lap_time)))
+    return lap_times
+
+
+def fastest_lap_time(session, car_id, details):
+    """
+    Looks up the player who drove the lap of a fastest lap event (FTLP). car_id is the
+    player car index of the client that sent the event.
+
+    Returns: a (player_name, lap_time, data) tuple like collect_lap_times, or None if the
+    lap was not driven by a player or the session lacks the data
+    """
+
+    vehicle_idx = details["vehicleIdx"]
+    lap_time = details["lapTime"]
+    participant = session.query(car_id, PacketIDs.PARTICIPANTS_DATA,
+        "content/m_participants[%d]" % vehicle_idx)
+    if "error" in participant or participant["m_aiControlled"] != 0:
+        return None
+
+    track_id = session.query(car_id, PacketIDs.SESSION_DATA, "content/m_trackId")
+    session_type = session.query(car_id, PacketIDs.SESSION_DATA, "content/m_sessionType")
+    tyre_id = session.query(car_id, PacketIDs.CAR_STATUS_DATA,
+        "content/m_carStatusData[%d]/m_visualTyreCompound" % vehicle_idx)
+    if type(track_id) is dict or type(tyre_id) is dict:
+        return None
+
+    player_name = participant["m_name"]
+    return (player_name, lap_time,
+        (player_name, track_id, session_type, participant["m_teamId"], tyre_id, lap_time))
+
+
+class BestLapTimes:
+    """
+    Keeps the best lap time per player and session until the session has ended
+    and its best times have been taken for the database
+    """
+
+    def __init__(self):
+        # {session_uid: {player_name: (lap_time, data, taken)}}
+        self.best_times = {}
+
+    def register(self, session_uid, player_name, last_time, data) -> bool:
+        """
+        Register a current 'last lap time' if it is faster than the previous best time.
+        Times are registered per player, and players are registered per session.
+
+        Returns: True if the time is a new best time
+        """
+
+        session_times = self.best_times.setdefault(session_uid, {})
+        if player_name in session_times and last_time >= session_times[player_name][0]:
+            return False
+        session_times[player_name] = (last_time, data, False)
+        return True
+
+    def take_finished(self, is_active) -> list:
+        """
+        Takes the best times of all sessions that are no longer active. is_active is
+        called with a session UID and returns whether the session is still active.
+        Every best time is only taken once.
+
+        Returns: a list of the data tuples of the best times
+        """
+
+        finished = []
+        for session_uid, session_times in self.best_times.items():
+            if is_active(session_uid):
+                continue
+            for player_name, (lap_time, data, taken) in session_times.items():
+                if taken:
+                    continue
+                finished.append(data)
+                session_times[player_name] = (lap_time, data, True)
+        return finished
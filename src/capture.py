@@ -0,0 +1,129 @@
+import time
+import socket
+import struct
+import threading
+import collections
+
+# Captures are binary files that start with a file header, followed by one record
+# per datagram. Each record is a record header followed by the datagram itself.
+# File header: magic, format version, wall clock time (time.time) and monotonic
+#   time (time.monotonic_ns) of the start of the capture
+# Record header: monotonic receive time in nanoseconds, IPv4 source address, source
+#   port and size of the datagram
+CAPTURE_MAGIC = b"F1CAP"
+CAPTURE_VERSION = 1
+FILE_HEADER_STRUCT = struct.Struct("<5sBdQ")
+RECORD_HEADER_STRUCT = struct.Struct("<Q4sHH")
+
+# Source address for datagrams without an IPv4 source
+UNKNOWN_ADDRESS = b"\0\0\0\0"
+
+
+def _pack_address(addr) -> bytes:
+    try:
+        return socket.inet_aton(addr[0])
+    except (OSError, TypeError, IndexError):
+        return UNKNOWN_ADDRESS
+
+
+class CaptureWriter:
+    """
+    Records datagrams to a capture file. tap() only appends the datagram to a
+    bounded in-memory buffer, so it never blocks the receive loop that calls it.
+    A background thread writes the buffered records in batches. If the buffer is
+    full, new records are dropped and counted.
+    """
+
+    def __init__(self, filename, capacity=65536, flush_interval=0.1):
+        """
+        filename: the capture file, an existing file is overwritten
+
+        capacity: the maximum number of records that are buffered
+
+        flush_interval: time in seconds between writes of the background thread
+        """
+
+        self._file = open(filename, "wb")
+        self._file.write(FILE_HEADER_STRUCT.pack(CAPTURE_MAGIC, CAPTURE_VERSION, time.time(), time.monotonic_ns()))
+        self._capacity = capacity
+        self._flush_interval = flush_interval
+        self._records = collections.deque()
+        self._should_end = threading.Event()
+        self.recorded_count = 0
+        self.dropped_count = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def tap(self, datagram, addr) -> None:
+        """
+        Records a datagram received from addr. The datagram is copied, so views of
+        reusable buffers can be passed.
+        """
+
+        if len(self._records) >= self._capacity:
+            self.dropped_count += 1
+            return
+        self._records.append((time.monotonic_ns(), addr, bytes(datagram)))
+
+    def _write_pending(self) -> None:
+        records = self._records
+        data = bytearray()
+        count = 0
+        while records:
+            timestamp, addr, datagram = records.popleft()
+            data += RECORD_HEADER_STRUCT.pack(timestamp, _pack_address(addr), addr[1] if addr else 0, len(datagram))
+            data += datagram
+            count += 1
+        if count > 0:
+            self._file.write(data)
+            self.recorded_count += count
+
+    def _run(self):
+        while not self._should_end.wait(self._flush_interval):
+            self._write_pending()
+
+    def stats(self) -> dict:
+        return {
+            "recorded": self.recorded_count,
+            "dropped": self.dropped_count,
+            "buffered": len(self._records),
+        }
+
+    def close(self) -> None:
+        """
+        Stops the background thread, writes all buffered records and closes the file
+        """
+
+        self._should_end.set()
+        self._thread.join()
+        self._write_pending()
+        self._file.close()
+
+
+def read_capture(filename):
+    """
+    Reads a capture file.
+
+    Returns: a generator of (timestamp_ns, addr, datagram) tuples, timestamps are
+    monotonic receive times in nanoseconds
+    """
+
+    with open(filename, "rb") as capture_file:
+        header = capture_file.read(FILE_HEADER_STRUCT.size)
+        if len(header) < FILE_HEADER_STRUCT.size or FILE_HEADER_STRUCT.unpack(header)[0] != CAPTURE_MAGIC:
+            raise ValueError("'%s' is not a capture file" % filename)
+        version = FILE_HEADER_STRUCT.unpack(header)[1]
+        if version != CAPTURE_VERSION:
+            raise ValueError("Unsupported capture version %d" % version)
+
+        while True:
+            record_header = capture_file.read(RECORD_HEADER_STRUCT.size)
+            if len(record_header) < RECORD_HEADER_STRUCT.size:
+                break
+            timestamp, address, port, size = RECORD_HEADER_STRUCT.unpack(record_header)
+            datagram = capture_file.read(size)
+            if len(datagram) < size:
+                # Incomplete last record, e.g. the recording process was killed
+                break
+            yield timestamp, (socket.inet_ntoa(address), port), datagram
@@ -1,6 +1,210 @@
+import os
+import time
 import socket
+import select
 import threading
 import traceback
+import collections
+
+# Size of the receive buffers, large enough for every F1 packet
+MAX_DATAGRAM_SIZE = 4096
+DEFAULT_PORT = 20777
+
+
+def address_to_target(address_str: str, default_port=DEFAULT_PORT):
+    """
+    Converts an address string like 'localhost:20777' to an (address, port)
+    tuple. If no port is given, default_port is used
+    """
+
+    if ":" in address_str:
+        address = address_str.split(":")[0]
+        port = int(address_str.split(":")[1])
+    else:
+        address = address_str
+        port = default_port
+    return (address, port)
+
+def kernel_drop_count(sock):
+    """
+    Returns the number of datagrams the kernel dropped for the given udp socket,
+    e.g. because its receive buffer was full, or None if the operating system
+    does not expose it. On Linux, it is read from the drops column of
+    /proc/net/udp (or udp6), where the socket is identified by its inode
+    """
+
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        for table in ("/proc/net/udp", "/proc/net/udp6"):
+            with open(table, "r") as udp_table:
+                for line in udp_table.readlines()[1:]:
+                    columns = line.split()
+                    if len(columns) >= 13 and columns[9] == inode:
+                        return int(columns[12])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class IngestStats:
+    """
+    Counters of received datagrams: datagrams per packet ID, received bytes and
+    decode errors. Counting is cheap enough for the receive loop, snapshot()
+    can be called from any thread at any time.
+    """
+
+    def __init__(self, sock=None):
+        """
+        sock: the socket whose kernel drop count is included in the snapshots
+        """
+
+        self._socket = sock
+        self._start_time = time.monotonic()
+        self.datagram_counts = {}
+        self.total_bytes = 0
+        self.decode_errors = 0
+
+    def count(self, packet) -> None:
+        """
+        Counts a received datagram, before it is decoded
+        """
+
+        self.total_bytes += len(packet)
+        packet_id = packet[5] if len(packet) > 5 else None
+        self.datagram_counts[packet_id] = self.datagram_counts.get(packet_id, 0) + 1
+
+    def snapshot(self) -> dict:
+        """
+        Returns a copy of the current counters. Rates are averaged since the
+        counters were created, the difference between two snapshots gives the
+        rates of the time in between.
+        """
+
+        elapsed = time.monotonic() - self._start_time
+        datagram_counts = self.datagram_counts.copy()
+        datagrams = sum(datagram_counts.values())
+        return {
+            "elapsed": elapsed,
+            "datagrams": datagrams,
+            "datagrams_per_packet_id": datagram_counts,
+            "datagrams_per_second": datagrams / elapsed if elapsed > 0 else 0.0,
+            "bytes": self.total_bytes,
+            "bytes_per_second": self.total_bytes / elapsed if elapsed > 0 else 0.0,
+            "decode_errors": self.decode_errors,
+            "kernel_drops": kernel_drop_count(self._socket) if self._socket else None,
+        }
+
+
+class PriorityPacketQueue:
+    """
+    Bounded queue of raw datagrams between receiving and decoding. Datagrams are
+    taken in the order of the priorities of their packet IDs (0 is the highest
+    priority), so important packets are decoded first when decoding falls behind.
+    If the queue is full, the oldest datagram with the lowest priority (at most
+    that of the new datagram) is dropped to make room, otherwise the new datagram
+    is dropped. Packet IDs can have rate caps (datagrams per second per source),
+    which are applied once the queue is filled to rate_cap_threshold.
+    Dropped (shed) datagrams are counted per packet ID.
+    """
+
+    def __init__(self, capacity=4096, priorities=None, rate_caps=None, rate_cap_threshold=0.0,
+            default_priority=1):
+        """
+        capacity: the maximum number of queued datagrams
+
+        priorities: dict that maps packet IDs to their priority, lower values are more
+                    important. Packet IDs without priority get default_priority
+
+        rate_caps: dict that maps packet IDs to the maximum number of datagrams per
+                    second and source that are queued
+
+        rate_cap_threshold: fill level of the queue (from 0.0 to 1.0) from which on the
+                    rate caps are applied. With 0.0 they are always applied
+        """
+
+        self._capacity = capacity
+        self._priorities = priorities or {}
+        self._default_priority = default_priority
+        self._intervals = {packet_id: 1.0 / rate for packet_id, rate in (rate_caps or {}).items() if rate > 0}
+        self._rate_cap_length = int(capacity * rate_cap_threshold)
+        self._last_queued = {}
+        levels = max([default_priority] + list(self._priorities.values())) + 1
+        self._queues = [collections.deque() for i in range(levels)]
+        self._length = 0
+        self._condition = threading.Condition()
+        self.rate_capped_counts = {}
+        self.overflow_counts = {}
+
+    def __len__(self):
+        return self._length
+
+    def shed_counts(self) -> dict:
+        """
+        Returns copies of the numbers of shed datagrams per packet ID, because of
+        their rate caps and because the queue was full
+        """
+
+        return {
+            "rate_cap": self.rate_capped_counts.copy(),
+            "overflow": self.overflow_counts.copy(),
+        }
+
+    def _count(self, counts, packet_id):
+        counts[packet_id] = counts.get(packet_id, 0) + 1
+
+    def put(self, packet, addr) -> bool:
+        """
+        Queues a datagram, unless it is shed.
+
+        Returns: True if the datagram was queued
+        """
+
+        packet_id = packet[5] if len(packet) > 5 else None
+        with self._condition:
+            interval = self._intervals.get(packet_id)
+            if interval is not None and self._length >= self._rate_cap_length:
+                now = time.monotonic()
+                key = (addr, packet_id)
+                if now - self._last_queued.get(key, 0.0) < interval:
+                    self._count(self.rate_capped_counts, packet_id)
+                    return False
+                self._last_queued[key] = now
+
+            priority = self._priorities.get(packet_id, self._default_priority)
+            if self._length >= self._capacity:
+                # Make room by dropping the oldest datagram of the lowest priority
+                for level in range(len(self._queues) - 1, priority - 1, -1):
+                    if self._queues[level]:
+                        dropped = self._queues[level].popleft()[0]
+                        self._count(self.overflow_counts, dropped[5] if len(dropped) > 5 else None)
+                        self._length -= 1
+                        break
+                else:
+                    self._count(self.overflow_counts, packet_id)
+                    return False
+
+            self._queues[priority].append((packet, addr))
+            self._length += 1
+            self._condition.notify()
+        return True
+
+    def get(self, timeout=None):
+        """
+        Takes the next datagram with the highest priority, waits up to timeout
+        seconds for one.
+
+        Returns: a (packet, addr) tuple, or None if the queue remained empty
+        """
+
+        with self._condition:
+            if self._length == 0 and not self._condition.wait(timeout):
+                return None
+            for queue in self._queues:
+                if queue:
+                    self._length -= 1
+                    return queue.popleft()
+        return None
+
 
 class UDPThread:
     """
@@ -9,45 +213,102 @@ class UDPThread:
         
     """
 
-    def __init__(self, port, packet_decoder=None, packet_handler=None):
+    def __init__(self, port, packet_decoder=None, packet_handler=None, batch_size=0, receive_buffer_size=0,
+            address="localhost", reuse_port=False, packet_queue=None, capture=None):
         """
         Initializes the thread wrapper.
             port: the port on which the udp socket will listen for incoming packets
 
             packet_decoder: the raw binary data packet is passed to this function and then
-                        replaced by its return value.
+                        replaced by its return value. If the decoder returns None, the
+                        packet is dropped. Decoders with a takes_source attribute that is
+                        True also get the source address as source keyword argument.
                         If not provided: keep raw binary data
 
             packet_handler: the decoded packet (or raw binary data if no decoder was provided)
                         is passed to the packet handler. This is where the packet leaves
                         the UDPThread packet pipeline.
                         If not provided: the packet will be dropped
+
+            batch_size: if greater than 0, datagrams are received with recv_into into a
+                        preallocated ring of buffers. After each wakeup, all pending
+                        datagrams (up to batch_size) are received without blocking and
+                        then handed to the decoder as one batch. Decoders are given a
+                        memoryview into the ring, so they must not keep references to it
+                        (decode_packet and decode_packet_lazy don't). Raw packets are
+                        copied before they are passed to the packet handler.
+                        If not provided: receive one datagram per recvfrom call
+
+            receive_buffer_size: size of the kernel receive buffer (SO_RCVBUF) in bytes,
+                        larger buffers absorb bursts that would otherwise be dropped
+                        If not provided: use the system default
+
+            address: the address to which the udp socket is bound. The socket is bound
+                        here, so datagrams that are sent after the UDPThread is created
+                        are received once it is started
+
+            reuse_port: if True, the socket is bound with SO_REUSEPORT, so several
+                        processes can listen on the same port. The kernel distributes
+                        the datagrams by their source, so all datagrams of a source
+                        reach the same socket (only available on Linux and BSD)
+
+            packet_queue: a PriorityPacketQueue. If provided, received datagrams are only
+                        put into the queue, and they are decoded and handled on a second
+                        thread, so slow decoding sheds the least important packets
+                        instead of random ones
+
+            capture: a capture.CaptureWriter. If provided, every received datagram is
+                        recorded before it is decoded (or queued)
         """
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._socket.settimeout(1.0)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # SO_REUSEADDR would let the last bound socket take all datagrams
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        else:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if receive_buffer_size > 0:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+        self._socket.bind((address, port))
         self._should_end = False
+        self.stats = IngestStats(self._socket)
         self._packet_decoder = packet_decoder
+        self._decoder_takes_source = getattr(packet_decoder, "takes_source", False)
         self._packet_handler = packet_handler
-        self._thread = threading.Thread(target=self._run, args=(port,))
+        self._batch_size = batch_size
+        run = self._run_batched if batch_size > 0 else self._run
+        self._thread = threading.Thread(target=run)
         self._thread.daemon = True
+        self._packet_queue = packet_queue
+        self._capture = capture
+        self._decode_thread = None
+        if packet_queue is not None:
+            self._decode_thread = threading.Thread(target=self._run_decode)
+            self._decode_thread.daemon = True
 
 
-    def _run(self, port):
-        self._socket.bind(("localhost", port))
-
+    def _run(self):
         while not self._should_end:
             try:
                 # Read UDP packet
                 packet, addr = self._socket.recvfrom(4096)
                 if not packet:
                     break
+                self.stats.count(packet)
+                if self._capture is not None:
+                    self._capture.tap(packet, addr)
+
+                if self._packet_queue is not None:
+                    self._packet_queue.put(packet, addr)
+                    continue
                 
                 if self._packet_decoder:
-                    # Decode the packet
-                    packet = self._packet_decoder(bytearray(packet))
-                    
+                    # Decode the packet. The received bytes are passed on as they are,
+                    # decoders read them in place
+                    packet = self._decode(packet, addr)
+                    if packet is None:
+                        continue
 
                 if self._packet_handler:
                     self._packet_handler(packet)
@@ -59,11 +320,123 @@ class UDPThread:
                 traceback.print_exc()
                 break
 
+    def _decode(self, packet, addr):
+        """
+        Passes the packet to the decoder. Packets that can't be decoded are
+        counted as decode errors and dropped (None is returned)
+        """
+
+        try:
+            if self._decoder_takes_source:
+                return self._packet_decoder(packet, source=addr)
+            return self._packet_decoder(packet)
+        except Exception:
+            self.stats.decode_errors += 1
+            return None
+
+    def _process_batch(self, batch):
+        """
+        Decodes and handles a batch of (packet, addr) tuples
+        """
+
+        for packet, addr in batch:
+            self.stats.count(packet)
+            if self._capture is not None:
+                self._capture.tap(packet, addr)
+            if self._packet_queue is not None:
+                # The buffer is reused, so the queue gets its own copy
+                self._packet_queue.put(bytes(packet), addr)
+                continue
+
+            if self._packet_decoder:
+                packet = self._decode(packet, addr)
+                if packet is None:
+                    continue
+            else:
+                # The buffer is reused, so the handler gets its own copy
+                packet = bytes(packet)
+
+            if self._packet_handler:
+                self._packet_handler(packet)
+
+
+    def _run_batched(self):
+        self._socket.setblocking(False)
+
+        # Twice the batch size, so that a batch never reuses the buffers of
+        # the previous one
+        ring = [bytearray(MAX_DATAGRAM_SIZE) for i in range(2 * self._batch_size)]
+        views = [memoryview(buffer) for buffer in ring]
+        position = 0
+
+        while not self._should_end:
+            try:
+                # Wait for pending datagrams, time out to check for the end of the thread
+                readable, _, _ = select.select([self._socket], [], [], 1.0)
+                if not readable:
+                    continue
+
+                # Drain the socket until it would block
+                batch = []
+                while len(batch) < self._batch_size:
+                    try:
+                        size, addr = self._socket.recvfrom_into(ring[position])
+                    except BlockingIOError:
+                        break
+                    batch.append((views[position][:size], addr))
+                    position = (position + 1) % len(ring)
+
+                self._process_batch(batch)
+
+            except Exception as err:
+                print("UDPThread Error:", err)
+                traceback.print_exc()
+                break
+
+    def _run_decode(self):
+        """
+        Decodes and handles the datagrams from the packet queue
+        """
+
+        while not self._should_end:
+            try:
+                item = self._packet_queue.get(timeout=1.0)
+                if item is None:
+                    continue
+
+                packet, addr = item
+                if self._packet_decoder:
+                    packet = self._decode(packet, addr)
+                    if packet is None:
+                        continue
+
+                if self._packet_handler:
+                    self._packet_handler(packet)
+
+            except Exception as err:
+                print("UDPThread Error:", err)
+                traceback.print_exc()
+                break
+
+    def health(self) -> dict:
+        """
+        Returns a snapshot of the ingest counters, see IngestStats.snapshot. With a
+        packet queue, it also contains the queue length and the shed datagrams
+        """
+
+        health = self.stats.snapshot()
+        if self._packet_queue is not None:
+            health["queued"] = len(self._packet_queue)
+            health["shed"] = self._packet_queue.shed_counts()
+        return health
+
     def start(self):
         """
         Starts the thread and beginns receiving packets
         """
         self._thread.start()
+        if self._decode_thread is not None:
+            self._decode_thread.start()
     
     def stop(self):
         """
@@ -73,3 +446,5 @@ class UDPThread:
         """
         self._should_end = True
         self._thread.join()
+        if self._decode_thread is not None:
+            self._decode_thread.join()
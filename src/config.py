@@ -10,6 +10,7 @@ class Config:
 
     def __init__(self):
         self._values = {}
+        self.files = []
 
     def _load_values(self, data: any, parent_path=""):
         """ 
@@ -44,15 +45,27 @@ class Config:
             print(err)
 
 
+MAIN_CONFIG_FILE = "config.json"
+
+def load_config(filename: str=MAIN_CONFIG_FILE) -> Config:
+    """
+    Loads the main config file and the additional config files it lists.
+    If these additional files contain the same keys as the main file, the main
+    files values will be overwritten. The names of all loaded files are stored
+    in the files attribute of the returned config.
+    """
+
+    config = Config()
+    config._load_from_file(filename)
+    config.files = [filename]
+
+    config_files = config.get("/configFiles")
+    if type(config_files) is list:
+        for config_file in config_files:
+            config._load_from_file(config_file)
+            config.files.append(config_file)
+    return config
+
+
 # Global config file object
-CONFIG = Config()
-CONFIG._load_from_file("config.json")
-
-# Get additional config files from the main config file and load their values.
-# If these additional files contain the same keys as the main file, the main
-# files values will be overwritten.
-config_files = CONFIG.get("/configFiles")
-if type(config_files) is list:
-    for config_file in config_files:
-        CONFIG._load_from_file(config_file)
-del(config_files)
+CONFIG = load_config()
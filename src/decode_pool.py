@@ -0,0 +1,229 @@
+import socket
+import select
+import struct
+import threading
+import traceback
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import f1.f1decode as f1decode
+
+# Size of the slots in the shared memory ring, large enough for every F1 packet
+SLOT_SIZE = 2048
+
+# Reads only the m_sessionUID field of a packet header
+SESSION_UID_STRUCT = struct.Struct("<6xQ")
+
+
+def _decode_worker(shm_name, tasks, results, decoder_factory):
+    """
+    Main function of the decode worker processes. Receives batches of
+    (slot, size, addr) tasks, decodes the datagrams in these slots of the shared
+    memory ring and sends back batches of (slot, packet) results. Packets are sent
+    back as f1decode.CompactPacket, so the receiving process does not have to
+    rebuild every record when it unpickles them
+    """
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    decoder = decoder_factory() if decoder_factory else f1decode.decode_packet
+    takes_source = getattr(decoder, "takes_source", False)
+    try:
+        while True:
+            batch = tasks.get()
+            if batch is None:
+                break
+
+            decoded = []
+            for slot, size, addr in batch:
+                start = slot * SLOT_SIZE
+                packet = None
+                try:
+                    with shm.buf[start:start + size] as datagram:
+                        if takes_source:
+                            packet = decoder(datagram, source=addr)
+                        else:
+                            packet = decoder(datagram)
+                    packet = f1decode.compact_packet(packet)
+                except Exception as err:
+                    print("Decode worker error:", err)
+                decoded.append((slot, packet))
+            results.put(decoded)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shm.close()
+
+
+class DecodePool:
+    """
+    Receives udp packets on a lean receive thread and decodes them in a pool of
+    worker processes, so decoding does not compete with receiving for the GIL.
+    Datagrams are received directly into a ring of slots in shared memory, the
+    workers decode them there and send the decoded packets back. Packets are
+    assigned to workers by their session UID, so the packets of a session are
+    always decoded by the same worker and handed to the packet handler in the
+    order of their frame identifiers, as they were received.
+    Has the same start/stop interface as client.UDPThread.
+    """
+
+    def __init__(self, port, decoder_factory=None, packet_handler=None, workers=2, slots=4096, receive_buffer_size=0,
+            address="localhost", batch_size=64, capture=None):
+        """
+        Initializes the decode pool.
+            port: the port on which the udp socket will listen for incoming packets
+
+            decoder_factory: called once in every worker process to create the packet
+                        decoder (see client.UDPThread), e.g. f1decode.MemoDecoder. Decoded
+                        packets are sent back to this process, so they have to be
+                        picklable: packets of decode_packet are, lazy packets are not.
+                        If not provided: f1decode.decode_packet
+
+            packet_handler: the decoded packets are passed to the packet handler, which
+                        is called on a separate thread of this process.
+                        If not provided: the packet will be dropped
+
+            workers: the number of decode worker processes
+
+            slots: the number of datagrams the shared memory ring can hold. If all slots
+                        are in use, newly received datagrams are dropped and counted
+
+            receive_buffer_size: size of the kernel receive buffer (SO_RCVBUF) in bytes
+                        If not provided: use the system default
+
+            address: the address to which the udp socket is bound
+
+            batch_size: the maximum number of datagrams that are received before they
+                        are handed to the workers
+
+            capture: a capture.CaptureWriter. If provided, every received datagram is
+                        recorded, including the ones that are dropped because all slots
+                        are in use
+        """
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if receive_buffer_size > 0:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+        self._bind_address = (address, port)
+        self._batch_size = max(1, batch_size)
+        self._should_end = False
+        self._packet_handler = packet_handler
+        self._capture = capture
+
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * SLOT_SIZE)
+        self._slot_views = [self._shm.buf[i * SLOT_SIZE:(i + 1) * SLOT_SIZE] for i in range(slots)]
+        self._free_slots = collections.deque(range(slots))
+        self.dropped_count = 0
+
+        self._results = multiprocessing.Queue()
+        self._tasks = [multiprocessing.Queue() for i in range(workers)]
+        self._workers = [
+            multiprocessing.Process(target=_decode_worker, args=(self._shm.name, tasks, self._results, decoder_factory))
+            for tasks in self._tasks
+        ]
+        for worker in self._workers:
+            worker.daemon = True
+
+        self._receive_thread = threading.Thread(target=self._run_receive)
+        self._receive_thread.daemon = True
+        self._handler_thread = threading.Thread(target=self._run_handler)
+        self._handler_thread.daemon = True
+
+
+    def _run_receive(self):
+        self._socket.bind(self._bind_address)
+        self._socket.setblocking(False)
+        scratch = bytearray(SLOT_SIZE)
+        worker_count = len(self._tasks)
+
+        while not self._should_end:
+            try:
+                readable, _, _ = select.select([self._socket], [], [], 1.0)
+                if not readable:
+                    continue
+
+                # Drain the socket until it would block (up to the batch size), batch the
+                # tasks per worker
+                batches = [[] for i in range(worker_count)]
+                for i in range(self._batch_size):
+                    if not self._free_slots:
+                        # The ring is full: receive and drop the datagram
+                        try:
+                            size, addr = self._socket.recvfrom_into(scratch)
+                        except BlockingIOError:
+                            break
+                        if self._capture is not None:
+                            self._capture.tap(memoryview(scratch)[:size], addr)
+                        self.dropped_count += 1
+                        continue
+
+                    slot = self._free_slots.popleft()
+                    try:
+                        size, addr = self._socket.recvfrom_into(self._slot_views[slot])
+                    except BlockingIOError:
+                        self._free_slots.appendleft(slot)
+                        break
+                    if self._capture is not None:
+                        self._capture.tap(self._slot_views[slot][:size], addr)
+
+                    session_uid = 0
+                    if size >= SESSION_UID_STRUCT.size:
+                        session_uid = SESSION_UID_STRUCT.unpack_from(self._slot_views[slot])[0]
+                    batches[session_uid % worker_count].append((slot, size, addr))
+
+                for tasks, batch in zip(self._tasks, batches):
+                    if batch:
+                        tasks.put(batch)
+
+            except Exception as err:
+                print("DecodePool Error:", err)
+                traceback.print_exc()
+                break
+
+    def _run_handler(self):
+        while True:
+            decoded = self._results.get()
+            if decoded is None:
+                break
+
+            for slot, packet in decoded:
+                self._free_slots.append(slot)
+                if packet is not None and self._packet_handler:
+                    try:
+                        self._packet_handler(packet)
+                    except Exception as err:
+                        print("DecodePool handler Error:", err)
+                        traceback.print_exc()
+
+    def start(self):
+        """
+        Starts the worker processes and the threads and beginns receiving packets
+        """
+
+        # Processes are started first, so they are not forked while threads run
+        for worker in self._workers:
+            worker.start()
+        self._handler_thread.start()
+        self._receive_thread.start()
+
+    def stop(self):
+        """
+        Ends the threads and worker processes. Packets that are already received
+        are still decoded and handled. This can take up to a second, since the
+        receive thread might have to time out before it can end.
+        """
+
+        self._should_end = True
+        self._receive_thread.join()
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._handler_thread.join()
+
+        self._socket.close()
+        for view in self._slot_views:
+            view.release()
+        self._shm.close()
+        self._shm.unlink()
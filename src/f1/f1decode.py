@@ -1,6 +1,17 @@
 import struct
 import math
+import itertools
+import functools
+import importlib
+import collections
+import f1structs
 from f1structs import *
+from f1enums import PacketIDs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Supported C datatypes and their corresponding format string
 # Format strings start with < to indicate that all data is little-endian
@@ -17,12 +28,27 @@ datatypes = {
     "double": (8, "<d"),
 }
 
+# NumPy type strings of the supported C datatypes, all little-endian
+numpy_datatypes = {
+    "uint8":  "<u1",
+    "uint16": "<u2",
+    "uint32": "<u4",
+    "uint64": "<u8",
+    "int8":   "<i1",
+    "int16":  "<i2",
+    "int32":  "<i4",
+    "int64":  "<i8",
+    "float":  "<f4",
+    "double": "<f8",
+}
+
 
-def extract_struct(bytestream, structname):
+def extract_struct(bytestream, structname, offset=0):
     """
-    Extracts one structure as dict from given bytestream.
+    Extracts one structure as dict from given bytestream, starting at offset.
     structname is a string containing the name of one of the structures
-    defined above.
+    defined above. The bytestream is never sliced or copied, so a memoryview
+    over the received datagram can be passed in directly.
 
     Returns: a tuple containing the decoded struct and the number of
     bytes read
@@ -30,46 +56,54 @@ def extract_struct(bytestream, structname):
 
     struct_data = {}
     total_bytes = 0
-    for attr in eval(structname):
-        value, bytes_read = extract_field(bytestream, attr[0])
-        bytestream = bytestream[bytes_read:]
+    for attr in getattr(f1structs, structname):
+        value, bytes_read = extract_field(bytestream, attr[0], offset + total_bytes)
         total_bytes += bytes_read
         struct_data[attr[1]] = value
     return struct_data, total_bytes
 
 
-def read_string_from_stream(bytestream, datatype):
+def decode_string(raw: bytes) -> str:
+    """
+    Decodes a fixed size char array. The string ends at the first null
+    character (or at the ellipsis the game uses to truncate long names)
+    """
+
+    string = raw.split(b"\x00", 1)[0].decode()
+    return string.split("\u2026", 1)[0]
+
+
+def encode_string(string: str) -> bytes:
+    """
+    Encodes a string for a fixed size char array, the inverse of decode_string.
+    Packing pads the array with null characters.
+    """
+
+    return string.encode()
+
+
+def read_string_from_stream(bytestream, datatype, offset=0):
     char_count = int(datatype.split("*")[1])
-    format_string = "<%ds" % char_count
-    string = bytestream[:char_count].decode()
-    string_length = 0
-    while string[string_length] not in "\u0000\u2026":
-        string_length += 1
-    return string[:string_length], char_count
+    raw = struct.unpack_from("<%ds" % char_count, bytestream, offset)[0]
+    return decode_string(raw), char_count
 
 
-def extract_field(bytestream, datatype):
+def extract_field(bytestream, datatype, offset=0):
     """
-    Extracts a single field from given bytestream. The datatype must
-    match one of those in the datatypes list above. If a struct name
-    is given, it will extract the entire struct.
+    Extracts a single field from given bytestream, starting at offset.
+    The datatype must match one of those in the datatypes list above.
+    If a struct name is given, it will extract the entire struct.
 
     Returns: a tuple containing the decoded field and the number of
     bytes read
     """
 
-    # Determine if the field is an array and if so, how many values
-    # need to be read
-
     if "char*" in datatype:
-         return read_string_from_stream(bytestream, datatype)
-
-    n = 1
-    if "*" in datatype:
-        split = datatype.split("*")
-        datatype = split[0]
-        n = int(split[1])
+         return read_string_from_stream(bytestream, datatype, offset)
 
+    # Determine if the field is an array and if so, how many values
+    # need to be read
+    datatype, n = _parse_datatype(datatype)
 
     value = 0
     bytes_read = 0
@@ -80,57 +114,1091 @@ def extract_field(bytestream, datatype):
             # Read array of structs
             value = []
             for i in range(n):
-                v, struct_size = extract_struct(bytestream, datatype)
-                bytestream = bytestream[struct_size:]
+                v, struct_size = extract_struct(bytestream, datatype, offset + bytes_read)
+                bytes_read += struct_size
                 value.append(v)
         else:
             # Read singular struct
-            value, bytes_read = extract_struct(bytestream, datatype)
+            value, bytes_read = extract_struct(bytestream, datatype, offset)
     # If the datatype is an integral type, read that value
     else:
         word_size, format_string = datatypes.get(datatype, (0, None))
         if format_string:
             if n > 1:
                 # Read array of integral data
-                value = []
-                offset = 0
-                for i in range(n):
-                    offset = i * word_size
-                    second_index = offset + word_size
-                    value.append(struct.unpack(format_string, bytestream[offset:second_index])[0])
-                bytes_read = offset + word_size
+                value = list(struct.unpack_from("<%d%s" % (n, format_string[1:]), bytestream, offset))
+                bytes_read = n * word_size
             else:
                 # Read singular integral value
-                value = struct.unpack(format_string, bytestream[:word_size])[0]
+                value = struct.unpack_from(format_string, bytestream, offset)[0]
                 bytes_read = word_size
     return value, bytes_read
 
 
-def decode_packet(bytestream):
+# Kinds of entries in a compiled struct layout
+_SCALAR = 0
+_ARRAY = 1
+_STRING = 2
+_STRUCT = 3
+_STRUCT_ARRAY = 4
+
+
+def _parse_datatype(datatype):
+    """
+    Splits a datatype like 'float*4' into its base type and element count
     """
-    Decode an entire UDP package. Returns a dict which contains
-    header and content data.
 
-    Returns: a dictionary containing the package header and content data
+    if "*" in datatype:
+        split = datatype.split("*")
+        return split[0], int(split[1])
+    return datatype, 1
+
+
+class Record(tuple):
     """
+    Compact, immutable record of a decoded structure. Records are tuples of
+    the member values and support the same read access as dicts, so they can
+    be used wherever decoded structures used to be dicts:
+        record["m_speed"], record.keys(), "m_speed" in record
+    Members can also be accessed as attributes: record.m_speed
+    One record class is generated per structure, see record_type.
+    """
+
+    __slots__ = ()
+
+    # Member names and their indices, set by record_type
+    _fields = ()
+    _index = {}
+    _tables_name = None
+    _structname = None
+
+    def __getitem__(self, key):
+        if type(key) is str:
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, name):
+        try:
+            return tuple.__getitem__(self, self._index[name])
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % item for item in self.items()
+        ))
+
+    def __reduce__(self):
+        return (_make_record, (self._tables_name, self._structname, tuple(self.values())))
 
-    # Read the packet header
-    header, bytes_read = extract_struct(bytestream, "struct_PacketHeader")
-    bytestream = bytestream[bytes_read:]
+    def keys(self):
+        return self._fields
 
-    # Check if that struct type exists / is implemented
-    packet_data = None
-    toplevel_struct_type = packet_ids.get(header["m_packetId"], None)
+    def values(self):
+        return tuple.__iter__(self)
+
+    def items(self):
+        return zip(self._fields, tuple.__iter__(self))
+
+    def get(self, name, default=None):
+        index = self._index.get(name)
+        if index is None:
+            return default
+        return tuple.__getitem__(self, index)
+
+    def _replace(self, **members):
+        """
+        Returns a copy of the record with the given members replaced
+        """
+
+        values = list(tuple.__iter__(self))
+        for name, value in members.items():
+            values[self._index[name]] = value
+        return type(self)(values)
+
+
+# Generated record classes, cached per tables module and structure name
+_record_types = {}
+
+
+def record_type(structname: str, tables=f1structs) -> type:
+    """
+    Returns the Record subclass for the structure with the given name, e.g.
+    "struct_CarTelemetryData". Classes are generated on first use and then
+    cached.
+    """
+
+    key = (tables.__name__, structname)
+    cls = _record_types.get(key)
+    if cls is None:
+        fields = tuple(name for datatype, name in getattr(tables, structname))
+        cls = type(structname[len("struct_"):], (Record,), {
+            "__slots__": (),
+            "_fields": fields,
+            "_index": {name: i for i, name in enumerate(fields)},
+            "_tables_name": tables.__name__,
+            "_structname": structname,
+        })
+        _record_types[key] = cls
+    return cls
+
+
+def _make_record(tables_name, structname, values):
+    """
+    Recreates a record when it is unpickled
+    """
+
+    cls = _record_types.get((tables_name, structname))
+    if cls is None:
+        cls = record_type(structname, importlib.import_module(tables_name))
+    return cls(values)
+
+
+def _compile_layout(fields, tables=f1structs):
+    """
+    Compiles a list of (datatype, name) tuples into a struct format string
+    (without byte order prefix) and a layout that describes how the flat tuple
+    returned by struct.unpack has to be regrouped into records and lists.
+    Struct names are resolved in the given tables module.
+
+    Returns: a tuple containing the format string and the layout
+    """
+
+    format_string = ""
+    layout = []
+    for datatype, name in fields:
+        datatype, n = _parse_datatype(datatype)
+        if datatype == "char":
+            format_string += "%ds" % n
+            layout.append((name, _STRING, n, None))
+        elif datatype.startswith("struct"):
+            sub_format, sub_layout = _compile_layout(getattr(tables, datatype), tables)
+            format_string += sub_format * n
+            layout.append((name, _STRUCT_ARRAY if n > 1 else _STRUCT, n,
+                (record_type(datatype, tables), sub_layout)))
+        else:
+            code = datatypes[datatype][1][1:]
+            if n > 1:
+                format_string += "%d%s" % (n, code)
+                layout.append((name, _ARRAY, n, None))
+            else:
+                format_string += code
+                layout.append((name, _SCALAR, 1, None))
+    return format_string, layout
+
+
+def _regroup(layout, values):
+    """
+    Builds the list of member values described by layout from an iterator over
+    the flat values returned by struct.unpack. Nested structures become records.
+    """
+
+    data = []
+    for name, kind, n, sub in layout:
+        if kind == _SCALAR:
+            data.append(next(values))
+        elif kind == _ARRAY:
+            data.append(list(itertools.islice(values, n)))
+        elif kind == _STRING:
+            data.append(decode_string(next(values)))
+        elif kind == _STRUCT:
+            data.append(sub[0](_regroup(sub[1], values)))
+        else:
+            record_cls, sub_layout = sub
+            data.append([record_cls(_regroup(sub_layout, values)) for i in range(n)])
+    return data
+
+
+def _flatten(layout, data, values):
+    """
+    Appends the member values of data (a record or dict) to values in the
+    order described by layout, the inverse of _regroup
+    """
+
+    for name, kind, n, sub in layout:
+        value = data[name]
+        if kind == _SCALAR:
+            values.append(value)
+        elif kind == _ARRAY:
+            values.extend(value)
+        elif kind == _STRING:
+            values.append(encode_string(value))
+        elif kind == _STRUCT:
+            _flatten(sub[1], value, values)
+        else:
+            for item in value:
+                _flatten(sub[1], item, values)
+    return values
+
+
+class StructCodec:
+    """
+    Precompiled codec for a list of (datatype, name) fields as they are defined
+    in f1structs. The entire structure is read by a single struct.Struct call
+    and then regrouped. If structname is given, the structure is returned as a
+    record of that structure, otherwise as a dict. Nested structures are
+    always records.
+    """
+
+    def __init__(self, fields, tables=f1structs, structname=None):
+        format_string, self._layout = _compile_layout(fields, tables)
+        self._names = tuple(name for datatype, name in fields)
+        self._record_type = record_type(structname, tables) if structname else None
+        self.struct = struct.Struct("<" + format_string)
+        self.size = self.struct.size
+
+    def unpack_from(self, buffer, offset=0):
+        """
+        Decodes the structure that starts at offset in buffer
+        """
+
+        values = _regroup(self._layout, iter(self.struct.unpack_from(buffer, offset)))
+        if self._record_type is None:
+            return dict(zip(self._names, values))
+        return self._record_type(values)
+
+    def pack(self, data) -> bytes:
+        """
+        Encodes the structure given as record or dict
+        """
+
+        return self.struct.pack(*_flatten(self._layout, data, []))
+
+
+# Reads only the m_packetId field of a packet header
+PACKET_ID_STRUCT = struct.Struct("<5xB")
+
+HEADER_CODEC = StructCodec(struct_PacketHeader, structname="struct_PacketHeader")
+
+# Compiled packet codecs (header and content), cached per packet ID
+_packet_codecs = {}
+
+
+def get_packet_codec(packet_id: int) -> StructCodec:
+    """
+    Returns the codec that decodes an entire packet (header and content) with
+    the given packet ID. Codecs are compiled on first use and then cached.
+    For packet IDs without a content structure, only the header is decoded.
+    """
+
+    codec = _packet_codecs.get(packet_id)
+    if codec is None:
+        codec = compile_packet_codec(packet_id)
+        _packet_codecs[packet_id] = codec
+    return codec
+
+
+def compile_packet_codec(packet_id: int, tables=f1structs) -> StructCodec:
+    """
+    Compiles the codec that decodes an entire packet (header and content) with
+    the given packet ID, using the structures of the given tables module
+    """
+
+    fields = [("struct_PacketHeader", "header")]
+    toplevel_struct_type = tables.packet_ids.get(packet_id, None)
     if toplevel_struct_type:
-        packet_data, bytes_read = extract_struct(bytestream, toplevel_struct_type)
+        fields.append((toplevel_struct_type, "content"))
+    return StructCodec(fields, tables)
+
+
+def decode_packet(bytestream, offset=0):
+    """
+    Decode an entire UDP package that starts at offset in bytestream. Returns
+    a dict which contains header and content data, both are records (see
+    Record). bytestream can be any object supporting the buffer protocol
+    (bytes, bytearray, memoryview), it is read in place and never copied.
+
+    Returns: a dictionary containing the package header and content data
+    """
+
+    packet_id = PACKET_ID_STRUCT.unpack_from(bytestream, offset)[0]
+    packet = get_packet_codec(packet_id).unpack_from(bytestream, offset)
+    packet.setdefault("content", None)
+    if packet_id == PacketIDs.EVENT_DATA:
+        content = packet["content"]
+        packet["content"] = content._replace(m_eventDetails=decode_event_details(
+            content["m_eventStringCode"], bytestream, offset + EVENT_DETAILS_OFFSET))
+    return packet
+
+
+def encode_packet(packet) -> bytes:
+    """
+    Encode a packet given as dict with header and content, the inverse of
+    decode_packet: decode_packet(encode_packet(packet)) == packet for every
+    packet returned by decode_packet. Header and content may be records or
+    dicts, the packet ID is taken from the header.
+
+    Returns: the datagram as bytes
+    """
+
+    header = packet["header"]
+    packet_id = header["m_packetId"]
+    content = packet["content"]
+    if packet_id == PacketIDs.EVENT_DATA:
+        details = encode_event_details(content["m_eventStringCode"], content["m_eventDetails"])
+        content = dict(content.items())
+        content["m_eventDetails"] = list(details)
+    return get_packet_codec(packet_id).pack({"header": header, "content": content})
+
+
+# Offset of the event details union within an event packet
+EVENT_DETAILS_OFFSET = HEADER_CODEC.size + 4
+
+# Size of the event details union
+EVENT_DETAILS_SIZE = 7
+
+# Compiled codecs of the event details variants, cached per event string code
+_event_detail_codecs = {}
+
+
+def _get_event_detail_codec(event_code: str):
+    """
+    Returns the codec of the event details variant for the given event string
+    code, or None if the event has no details
+    """
+
+    if event_code not in _event_detail_codecs:
+        codec = None
+        structname = event_details.get(event_code, None)
+        if structname:
+            codec = StructCodec(getattr(f1structs, structname), structname=structname)
+        _event_detail_codecs[event_code] = codec
+    return _event_detail_codecs[event_code]
+
+
+def decode_event_details(event_code: str, bytestream, offset=0):
+    """
+    Decodes the event details union that starts at offset in bytestream. The
+    variant is chosen by the event string code, e.g. "FTLP" decodes a
+    struct_FastestLap.
+
+    Returns: a record, or None if the event has no details
+    """
+
+    codec = _get_event_detail_codec(event_code)
+    if codec is None:
+        return None
+    return codec.unpack_from(bytestream, offset)
+
+
+def encode_event_details(event_code: str, details) -> bytes:
+    """
+    Encodes the event details for the given event string code into the raw
+    bytes of the union, padded to its full size
+    """
+
+    raw = b""
+    codec = _get_event_detail_codec(event_code)
+    if codec is not None and details is not None:
+        raw = codec.pack(details)
+    return raw.ljust(EVENT_DETAILS_SIZE, b"\x00")
+
+
+class LazyStructArray:
+    """
+    Read-only list of structs that are decoded one by one on first access.
+    Decoded structs are cached.
+    """
+
+    def __init__(self, buffer, offset, codec, n):
+        self._buffer = buffer
+        self._offset = offset
+        self._codec = codec
+        self._items = [None] * n
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        item = self._items[index]
+        if item is None:
+            if index < 0:
+                index += len(self._items)
+            item = self._codec.unpack_from(self._buffer, self._offset + index * self._codec.size)
+            self._items[index] = item
+        return item
+
+    def __iter__(self):
+        for i in range(len(self._items)):
+            yield self[i]
+
+
+class LazyStruct:
+    """
+    Read-only dict-like view of a structure. Members are decoded on first
+    access and then cached, arrays of structs are returned as LazyStructArray.
+    """
+
+    def __init__(self, buffer, offset, members):
+        self._buffer = buffer
+        self._offset = offset
+        self._members = members
+        self._values = {}
+
+    def __getitem__(self, name):
+        if name in self._values:
+            return self._values[name]
+        member_offset, decode_member = self._members[name]
+        value = decode_member(self._buffer, self._offset + member_offset)
+        self._values[name] = value
+        return value
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def keys(self):
+        return self._members.keys()
 
-    
+    def get(self, name, default=None):
+        if name in self._members:
+            return self[name]
+        return default
+
+
+def _decode_member(codec, name, buffer, offset):
+    return codec.unpack_from(buffer, offset)[name]
+
+
+def _decode_lazy_struct_array(codec, n, buffer, offset):
+    return LazyStructArray(buffer, offset, codec, n)
+
+
+def _compile_lazy_members(structname, tables=f1structs):
+    """
+    Compiles the members of a structure into a dict that maps member names to
+    their offset within the structure and a function that decodes the member
+
+    Returns: a dict {name: (offset, decode_member)}
+    """
+
+    members = {}
+    offset = 0
+    for datatype, name in getattr(tables, structname):
+        base_type, n = _parse_datatype(datatype)
+        if base_type.startswith("struct") and n > 1:
+            record_codec = StructCodec(getattr(tables, base_type), tables, base_type)
+            decode_member = functools.partial(_decode_lazy_struct_array, record_codec, n)
+            size = record_codec.size * n
+        else:
+            member_codec = StructCodec([(datatype, name)], tables)
+            decode_member = functools.partial(_decode_member, member_codec, name)
+            size = member_codec.size
+        members[name] = (offset, decode_member)
+        offset += size
+    return members
+
+
+# Compiled lazy member tables, cached per packet ID
+_lazy_members = {}
+
+
+class LazyPacket:
+    """
+    A packet whose header is decoded right away, while its content is only
+    decoded member by member when it is accessed. Supports the same dict-style
+    access as the packets returned by decode_packet: packet["header"] and
+    packet["content"].
+    """
+
+    def __init__(self, bytestream, offset=0):
+        # The packet keeps a reference to the datagram, so it has to own an
+        # immutable copy if it is given a (possibly reused) mutable buffer
+        if not isinstance(bytestream, bytes):
+            bytestream = bytes(bytestream)
+        self.header = HEADER_CODEC.unpack_from(bytestream, offset)
+        self.content = None
+
+        packet_id = self.header["m_packetId"]
+        toplevel_struct_type = packet_ids.get(packet_id, None)
+        if packet_id == PacketIDs.EVENT_DATA:
+            # Event packets are tiny, but their details depend on the event code
+            self.content = decode_packet(bytestream, offset)["content"]
+        elif toplevel_struct_type:
+            members = _lazy_members.get(packet_id)
+            if members is None:
+                members = _compile_lazy_members(toplevel_struct_type)
+                _lazy_members[packet_id] = members
+            self.content = LazyStruct(bytestream, offset + HEADER_CODEC.size, members)
+
+    def __getitem__(self, name):
+        if name == "header":
+            return self.header
+        if name == "content":
+            return self.content
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in ("header", "content")
+
+    def keys(self):
+        return ("header", "content")
+
+
+def decode_packet_lazy(bytestream, offset=0):
+    """
+    Decode only the header of a UDP package right away. The content is
+    decoded on first access.
+
+    Returns: a LazyPacket
+    """
+
+    return LazyPacket(bytestream, offset)
+
+
+# Codecs of single structures for compact packets, cached per tables module name
+# and structure name
+_record_codecs = {}
+
+
+def _get_record_codec(tables_name: str, structname: str) -> StructCodec:
+    key = (tables_name, structname)
+    codec = _record_codecs.get(key)
+    if codec is None:
+        tables = importlib.import_module(tables_name)
+        codec = StructCodec(getattr(tables, structname), tables, structname)
+        _record_codecs[key] = codec
+    return codec
+
+
+def _compact_record(record):
+    if record is None:
+        return None
+    codec = _get_record_codec(record._tables_name, record._structname)
+    return (record._tables_name, record._structname, codec.pack(record))
+
+
+def _expand_record(compact):
+    if compact is None:
+        return None
+    tables_name, structname, data = compact
+    return _get_record_codec(tables_name, structname).unpack_from(data)
+
+
+class CompactPacket:
+    """
+    A decoded packet in a form that is cheap to send to another process: header
+    and content are kept as packed bytes of their structures, so unpickling only
+    creates this object. They are decoded again on first access. Supports the same
+    dict-style access as the packets returned by decode_packet. Created by
+    compact_packet.
+    """
+
+    __slots__ = ("_compact_header", "_compact_content", "_header", "_content")
+
+    def __init__(self, compact_header, compact_content):
+        self._compact_header = compact_header
+        self._compact_content = compact_content
+        self._header = None
+        self._content = None
+
+    def __reduce__(self):
+        return (CompactPacket, (self._compact_header, self._compact_content))
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = _expand_record(self._compact_header)
+        return self._header
+
+    @property
+    def content(self):
+        if self._content is None and self._compact_content is not None:
+            self._content = _expand_record(self._compact_content)
+        return self._content
+
+    def __getitem__(self, name):
+        if name == "header":
+            return self.header
+        if name == "content":
+            return self.content
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in ("header", "content")
+
+    def keys(self):
+        return ("header", "content")
+
+
+def compact_packet(packet):
+    """
+    Converts a packet returned by decode_packet to a CompactPacket. Event packets
+    (whose details are decoded separately) and packets that are not made of
+    records, like lazy packets, are returned as they are.
+    """
+
+    if type(packet) is not dict:
+        return packet
+    header = packet["header"]
+    content = packet.get("content")
+    if not isinstance(header, Record) or not (content is None or isinstance(content, Record)):
+        return packet
+    if header["m_packetId"] == PacketIDs.EVENT_DATA:
+        return packet
+    return CompactPacket(_compact_record(header), _compact_record(content))
+
+
+def numpy_dtype(fields, tables=f1structs):
+    """
+    Builds a packed NumPy structured dtype for a list of (datatype, name)
+    fields as they are defined in f1structs. Arrays of structs become
+    sub-arrays of structured dtypes, so e.g. the m_speed values of all cars
+    can be accessed as one column. Requires NumPy.
+    """
+
+    dtype_fields = []
+    for datatype, name in fields:
+        base_type, n = _parse_datatype(datatype)
+        if base_type == "char":
+            dtype_fields.append((name, "S%d" % n))
+            continue
+        if base_type.startswith("struct"):
+            item_type = numpy_dtype(getattr(tables, base_type), tables)
+        else:
+            item_type = numpy_datatypes[base_type]
+        if n > 1:
+            dtype_fields.append((name, item_type, (n,)))
+        else:
+            dtype_fields.append((name, item_type))
+    return numpy.dtype(dtype_fields)
+
+
+# NumPy dtypes of packet contents, cached per packet ID
+_content_dtypes = {}
+
+
+def get_content_dtype(packet_id: int):
+    """
+    Returns the NumPy dtype of the content of packets with the given packet ID,
+    or None if there is no content structure for that packet ID. Requires NumPy.
+    """
+
+    if packet_id not in _content_dtypes:
+        dtype = None
+        toplevel_struct_type = packet_ids.get(packet_id, None)
+        if toplevel_struct_type:
+            dtype = numpy_dtype(getattr(f1structs, toplevel_struct_type))
+        _content_dtypes[packet_id] = dtype
+    return _content_dtypes[packet_id]
+
+
+def decode_packet_numpy(bytestream, offset=0):
+    """
+    Decode a UDP package into columnar form. The header is decoded into a record
+    like in decode_packet, the content is a NumPy structured record that is a
+    view on bytestream (no data is copied). Arrays of per car structs can be
+    accessed column-wise, e.g.:
+        packet["content"]["m_carTelemetryData"]["m_speed"]
+    Since the content is a view, bytestream must not be reused while the packet
+    is in use. Strings are returned as raw bytes.
+    If NumPy is not installed, and for event packets (which have no columns),
+    this falls back to decode_packet.
+
+    Returns: a dictionary containing the package header and content data
+    """
+
+    if numpy is None or PACKET_ID_STRUCT.unpack_from(bytestream, offset)[0] == PacketIDs.EVENT_DATA:
+        return decode_packet(bytestream, offset)
+
+    header = HEADER_CODEC.unpack_from(bytestream, offset)
+    content = None
+    dtype = get_content_dtype(header["m_packetId"])
+    if dtype is not None:
+        content = numpy.frombuffer(bytestream, dtype=dtype, count=1, offset=offset + HEADER_CODEC.size)[0]
     return {
         "header": header,
-        "content": packet_data
+        "content": content
     }
 
 
+def decode_many(buffers) -> dict:
+    """
+    Decode many UDP packages at once into columnar form, e.g. to reprocess
+    recorded sessions. Packets are grouped by packet ID and each group is
+    copied into one preallocated NumPy structured array with one row per
+    packet, the per car arrays have one column per car:
+        result["packets"][PacketIDs.LAP_DATA]["content"]["m_lapData"]["m_lastLapTime"]
+    is an array of shape (number of lap data packets, 22).
+    Buffers that are too short for their packet type are skipped and counted.
+    The details of event packets are kept as the raw bytes of the union.
+    If NumPy is not installed, headers and contents are returned as lists of
+    records like decode_packet produces.
+
+    Returns: a dict with the keys
+        "header": table of all packet headers, in the order of buffers
+        "packets": a dict per packet ID with the keys "index" (rows in the
+                   header table), "header" and "content" (None for packet IDs
+                   without content structure)
+        "malformed": the number of skipped buffers
+    """
+
+    header_size = HEADER_CODEC.size
+    groups = {}
+    valid_buffers = []
+    malformed = 0
+    for buffer in buffers:
+        if len(buffer) < header_size:
+            malformed += 1
+            continue
+        packet_id = PACKET_ID_STRUCT.unpack_from(buffer)[0]
+        if len(buffer) < get_packet_codec(packet_id).size:
+            malformed += 1
+            continue
+        groups.setdefault(packet_id, []).append(len(valid_buffers))
+        valid_buffers.append(buffer)
+
+    if numpy is None:
+        packets = [decode_packet(buffer) for buffer in valid_buffers]
+        return {
+            "header": [packet["header"] for packet in packets],
+            "packets": {
+                packet_id: {
+                    "index": index,
+                    "header": [packets[i]["header"] for i in index],
+                    "content": [packets[i]["content"] for i in index] if packet_id in packet_ids else None,
+                }
+                for packet_id, index in groups.items()
+            },
+            "malformed": malformed,
+        }
+
+    headers = _copy_rows(valid_buffers, 0, numpy_dtype(struct_PacketHeader))
+    packets = {}
+    for packet_id, index in groups.items():
+        content = None
+        dtype = get_content_dtype(packet_id)
+        if dtype is not None:
+            content = _copy_rows([valid_buffers[i] for i in index], header_size, dtype)
+        index = numpy.array(index, dtype=numpy.intp)
+        packets[packet_id] = {
+            "index": index,
+            "header": headers[index],
+            "content": content,
+        }
+    return {
+        "header": headers,
+        "packets": packets,
+        "malformed": malformed,
+    }
+
+
+def _copy_rows(buffers, offset, dtype):
+    """
+    Copies dtype.itemsize bytes starting at offset from every buffer into one
+    preallocated array with one row per buffer
+    """
+
+    size = dtype.itemsize
+    rows = bytearray(len(buffers) * size)
+    view = memoryview(rows)
+    for i, buffer in enumerate(buffers):
+        view[i * size:(i + 1) * size] = memoryview(buffer)[offset:offset + size]
+    return numpy.frombuffer(rows, dtype=dtype)
+
+
+class SelectiveDecoder:
+    """
+    Packet decoder that only decodes packets with subscribed packet IDs. All
+    other packets are rejected after reading the packet ID from the header,
+    in that case None is returned instead of a packet. Rejected packets are
+    counted per packet ID.
+    """
+
+    def __init__(self, decoder=decode_packet, packet_ids=()):
+        """
+        decoder: the function that decodes wanted packets, e.g. decode_packet
+                    or decode_packet_lazy
+        packet_ids: the initially subscribed packet IDs
+        """
+
+        self._decoder = decoder
+        self.wanted_ids = set(packet_ids)
+        self.decoded_count = 0
+        self.skipped_counts = {}
+
+    def subscribe(self, *packet_ids) -> None:
+        """
+        Start decoding packets with the given packet IDs
+        """
+
+        self.wanted_ids.update(packet_ids)
+
+    def unsubscribe(self, *packet_ids) -> None:
+        """
+        Stop decoding packets with the given packet IDs
+        """
+
+        self.wanted_ids.difference_update(packet_ids)
+
+    def skip_counts(self) -> dict:
+        """
+        Returns a copy of the number of rejected packets per packet ID
+        """
+
+        return dict(self.skipped_counts)
+
+    def __call__(self, bytestream, offset=0):
+        packet_id = PACKET_ID_STRUCT.unpack_from(bytestream, offset)[0]
+        if packet_id not in self.wanted_ids:
+            self.skipped_counts[packet_id] = self.skipped_counts.get(packet_id, 0) + 1
+            return None
+        self.decoded_count += 1
+        return self._decoder(bytestream, offset)
+
+
+# Packet types whose content rarely changes between packets
+MEMO_PACKET_IDS = (
+    PacketIDs.PARTICIPANTS_DATA, PacketIDs.CAR_SETUP_DATA, PacketIDs.LOBBY_INFO_DATA,
+)
+
+
+def _compile_memo_members(structname, tables=f1structs):
+    """
+    Compiles the members of a structure for MemoDecoder. Arrays of structs are
+    decoded record by record, so that the records can be interned.
+
+    Returns: a list of (name, offset, codec, n) tuples, n is 0 for members that
+    are not arrays of structs
+    """
+
+    members = []
+    offset = 0
+    for datatype, name in getattr(tables, structname):
+        base_type, n = _parse_datatype(datatype)
+        if base_type.startswith("struct") and n > 1:
+            codec = StructCodec(getattr(tables, base_type), tables, base_type)
+            members.append((name, offset, codec, n))
+            offset += codec.size * n
+        else:
+            codec = StructCodec([(datatype, name)], tables)
+            members.append((name, offset, codec, 0))
+            offset += codec.size
+    return members
+
+
+class MemoDecoder:
+    """
+    Packet decoder that memoizes the decoded content of slowly changing packets
+    (see MEMO_PACKET_IDS) in a bounded LRU cache keyed by packet ID and content
+    bytes. If the same content is received again, the previously decoded
+    content is returned without decoding it again. Per car records are
+    interned as well, so unchanged cars share one record across packets.
+    Decoded contents are shared between packets and must not be modified.
+    All other packets are decoded by the given decoder.
+    """
+
+    def __init__(self, decoder=decode_packet, packet_ids=MEMO_PACKET_IDS, max_contents=64, max_records=1024):
+        """
+        decoder: the function that decodes all other packets, e.g. decode_packet
+                    or decode_packet_lazy
+        packet_ids: the packet IDs whose contents are memoized
+        max_contents: the maximum number of memoized contents
+        max_records: the maximum number of interned records per structure
+        """
+
+        self._decoder = decoder
+        self._max_contents = max_contents
+        self._max_records = max_records
+        self._contents = collections.OrderedDict()
+        self._records = {}
+        self._members = {}
+        self._content_types = {}
+        for packet_id in packet_ids:
+            toplevel_struct_type = f1structs.packet_ids.get(packet_id, None)
+            if toplevel_struct_type:
+                self._members[packet_id] = _compile_memo_members(toplevel_struct_type)
+                self._content_types[packet_id] = record_type(toplevel_struct_type)
+        self.content_hits = 0
+        self.content_misses = 0
+        self.record_hits = 0
+        self.record_misses = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the content cache and the
+        interned records
+        """
+
+        return {
+            "content_hits": self.content_hits,
+            "content_misses": self.content_misses,
+            "record_hits": self.record_hits,
+            "record_misses": self.record_misses,
+        }
+
+    def _intern_record(self, codec, buffer, offset):
+        """
+        Returns the interned record for the bytes at offset in buffer
+        """
+
+        records = self._records.get(codec)
+        if records is None:
+            records = collections.OrderedDict()
+            self._records[codec] = records
+
+        raw = bytes(buffer[offset:offset + codec.size])
+        record = records.get(raw)
+        if record is not None:
+            self.record_hits += 1
+            records.move_to_end(raw)
+            return record
+
+        self.record_misses += 1
+        record = codec.unpack_from(raw)
+        records[raw] = record
+        if len(records) > self._max_records:
+            records.popitem(last=False)
+        return record
+
+    def _decode_content(self, packet_id, content):
+        values = []
+        for name, offset, codec, n in self._members[packet_id]:
+            if n:
+                values.append([
+                    self._intern_record(codec, content, offset + i * codec.size) for i in range(n)
+                ])
+            else:
+                values.append(codec.unpack_from(content, offset)[name])
+        return self._content_types[packet_id](values)
+
+    def __call__(self, bytestream, offset=0):
+        packet_id = PACKET_ID_STRUCT.unpack_from(bytestream, offset)[0]
+        if packet_id not in self._members:
+            return self._decoder(bytestream, offset)
+
+        content_offset = offset + HEADER_CODEC.size
+        content_end = offset + get_packet_codec(packet_id).size
+        key = (packet_id, bytes(memoryview(bytestream)[content_offset:content_end]))
+        content = self._contents.get(key)
+        if content is not None:
+            self.content_hits += 1
+            self._contents.move_to_end(key)
+        else:
+            self.content_misses += 1
+            content = self._decode_content(packet_id, key[1])
+            self._contents[key] = content
+            if len(self._contents) > self._max_contents:
+                self._contents.popitem(last=False)
+
+        return {
+            "header": HEADER_CODEC.unpack_from(bytestream, offset),
+            "content": content,
+        }
+
+
+# Reads only the m_packetFormat field of a packet header, which is the first
+# field in the headers of all seasons
+PACKET_FORMAT_STRUCT = struct.Struct("<H")
+
+
+class FormatRegistry:
+    """
+    Packet decoder that selects the packet layouts by the m_packetFormat,
+    m_packetId and m_packetVersion fields of the header. Each supported season
+    is registered with its struct table module (like f1structs), codecs are
+    compiled on first use and cached per (m_packetFormat, m_packetId,
+    m_packetVersion). Packets with unknown formats, packet IDs or versions,
+    and packets that are too short for their layout, are rejected after
+    reading the header and counted per source; in that case None is returned.
+    """
+
+    # UDPThread passes the source address of each datagram to the decoder
+    takes_source = True
+
+    def __init__(self, decoder=decode_packet):
+        """
+        decoder: the function that decodes packets in the F1 2020 format
+                    (f1structs), e.g. decode_packet or a SelectiveDecoder
+        """
+
+        self._formats = {}
+        self._codecs = {}
+        self.rejected_counts = {}
+        self.register(f1structs, decoder)
+
+    def register(self, tables, decoder=None) -> None:
+        """
+        Registers a season. The tables module has to define struct_PacketHeader,
+        packet_ids, packet_format and packet_versions (which maps packet IDs to
+        their m_packetVersion) like f1structs does. If decoder is given, it
+        decodes the packets of that season, otherwise they are decoded by the
+        compiled codecs of the tables.
+        """
+
+        # Offsets of m_packetId and m_packetVersion in the header of the season
+        offsets = {}
+        offset = 0
+        for datatype, name in tables.struct_PacketHeader:
+            offsets[name] = offset
+            offset += StructCodec([(datatype, name)], tables).size
+        id_struct = struct.Struct("<%dxB%dxB" % (
+            offsets["m_packetVersion"],
+            offsets["m_packetId"] - offsets["m_packetVersion"] - 1,
+        ))
+
+        versions = {
+            packet_id: tables.packet_versions.get(packet_id, 1) for packet_id in tables.packet_ids.keys()
+        }
+        self._formats[tables.packet_format] = (tables, id_struct, versions, decoder)
+
+    def get_codec(self, packet_format: int, packet_id: int, packet_version: int):
+        """
+        Returns the codec that decodes an entire packet with the given format,
+        packet ID and version, or None if the packet is not supported
+        """
+
+        key = (packet_format, packet_id, packet_version)
+        codec = self._codecs.get(key)
+        if codec is None:
+            entry = self._formats.get(packet_format)
+            if entry is None or entry[2].get(packet_id) != packet_version:
+                return None
+            codec = compile_packet_codec(packet_id, entry[0])
+            self._codecs[key] = codec
+        return codec
+
+    def _reject(self, source) -> None:
+        self.rejected_counts[source] = self.rejected_counts.get(source, 0) + 1
+
+    def __call__(self, bytestream, offset=0, source=None):
+        size = len(bytestream) - offset
+        if size < PACKET_FORMAT_STRUCT.size:
+            self._reject(source)
+            return None
+        entry = self._formats.get(PACKET_FORMAT_STRUCT.unpack_from(bytestream, offset)[0])
+        if entry is None:
+            self._reject(source)
+            return None
+
+        tables, id_struct, versions, decoder = entry
+        if size < id_struct.size:
+            self._reject(source)
+            return None
+        packet_version, packet_id = id_struct.unpack_from(bytestream, offset)
+        codec = self.get_codec(tables.packet_format, packet_id, packet_version)
+        if codec is None or size < codec.size:
+            self._reject(source)
+            return None
+
+        if decoder is not None:
+            return decoder(bytestream, offset)
+        packet = codec.unpack_from(bytestream, offset)
+        packet.setdefault("content", None)
+        return packet
+
+
 def format_lap_time(lap_time_seconds: float) -> str:
     """
     Converts times from seconds in floating point format to strings that
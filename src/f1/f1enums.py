@@ -11,6 +11,20 @@ class PacketIDs:
     LOBBY_INFO_DATA = 9
 
 
+class EventCodes:
+    SESSION_STARTED = "SSTA"
+    SESSION_ENDED = "SEND"
+    FASTEST_LAP = "FTLP"
+    RETIREMENT = "RTMT"
+    DRS_ENABLED = "DRSE"
+    DRS_DISABLED = "DRSD"
+    TEAM_MATE_IN_PITS = "TMPT"
+    CHEQUERED_FLAG = "CHQF"
+    RACE_WINNER = "RCWN"
+    PENALTY_ISSUED = "PENA"
+    SPEED_TRAP_TRIGGERED = "SPTP"
+
+
 class TeamIDs:
     MERCEDES = 0
     FERRARI = 1
@@ -1,6 +1,40 @@
 import time
 import config
-from f1enums import PacketIDs
+import f1structs
+from f1enums import PacketIDs, EventCodes
+
+
+def per_car_arrays() -> dict:
+    """
+    Returns a dict that maps packet IDs to the name of the per car array
+    (struct_*Data*22) in their content, for all packets that have one
+    """
+
+    arrays = {}
+    for packet_id, structname in f1structs.packet_ids.items():
+        for datatype, name in getattr(f1structs, structname):
+            if datatype.startswith("struct") and datatype.endswith("*22"):
+                arrays[packet_id] = name
+    return arrays
+
+
+def watch_fields_from_config(defaults: dict) -> dict:
+    """
+    Reads the per car fields watched by the change feed from the config. Fields
+    are configured per per car array, e.g.:
+        /sessions/watchFields/m_lapData: ["m_carPosition", "m_pitStatus"]
+    Packet types that are not configured keep their default fields.
+
+    Returns: a dict {packet_id: (array_name, fields)}
+    """
+
+    watch_fields = dict(defaults)
+    for packet_id, array_name in per_car_arrays().items():
+        fields = config.CONFIG.get("/sessions/watchFields/" + array_name)
+        if type(fields) is list:
+            watch_fields[packet_id] = (array_name, tuple(fields))
+    return watch_fields
+
 
 class F1SessionManager:
     """
@@ -9,9 +43,56 @@ class F1SessionManager:
     that have become inactive
     """
 
-    def __init__(self):
+    def __init__(self, watch_fields=None, clock=time.time):
+        """
+        watch_fields: per car fields that are compared between packets for the
+                    change feed, as dict {packet_id: (array_name, fields)}.
+                    If not provided: F1Session.WATCH_FIELDS
+
+        clock: function that returns the current time in seconds, used for the
+                    session timeouts. Replays pass a clock that follows the
+                    timestamps of the capture
+                    If not provided: time.time
+        """
+
         self.sessions = {}
-    
+        self._event_handlers = {}
+        self._change_handlers = []
+        self._watch_fields = watch_fields if watch_fields is not None else F1Session.WATCH_FIELDS
+        self._clock = clock
+
+
+    def add_event_handler(self, event_code: str, handler) -> None:
+        """
+        Registers a handler for events with the given event string code (see
+        f1enums.EventCodes) in all sessions, including sessions that are created
+        later. The handler is called with the session and the event packet as
+        its parameters.
+        """
+
+        self._event_handlers.setdefault(event_code, []).append(handler)
+
+
+    def add_change_handler(self, handler) -> None:
+        """
+        Registers a handler for the change feed of all sessions, including
+        sessions that are created later. Whenever a packet with watched fields
+        is received, the handler is called with the session, the packet and
+        a list of (car, field, old, new) tuples for all watched per car fields
+        that changed since the previous packet of that type from the same
+        player. The handler is not called if nothing changed.
+        """
+
+        self._change_handlers.append(handler)
+
+
+    def health(self) -> dict:
+        """
+        Returns a snapshot of the health counters of all sessions, see F1Session.health
+        """
+
+        return {uid: session.health() for uid, session in list(self.sessions.items())}
+
 
     def dispatch_packet(self, packet) -> None:
         """
@@ -21,7 +102,8 @@ class F1SessionManager:
 
         session_uid = packet["header"]["m_sessionUID"]
         if not session_uid in self.sessions.keys():
-            self.sessions[session_uid] = F1Session()
+            self.sessions[session_uid] = F1Session(
+                self._event_handlers, self._change_handlers, self._watch_fields, self._clock)
         self.sessions[session_uid].receive_packet(packet)
 
     
@@ -55,7 +137,41 @@ class F1Session:
     LOBBY_PACKET_TIMEOUT = config.CONFIG.get("/sessions/lobbyPacketTimeout", 3.0)
     SESSION_ACTIVE_TIMEOUT = config.CONFIG.get("/sessions/sessionActiveTimeout", 10.0)
 
-    def __init__(self):
+    # Packet types that are needed to determine best lap times
+    BEST_LAP_PACKET_IDS = (
+        PacketIDs.SESSION_DATA, PacketIDs.LAP_DATA,
+        PacketIDs.PARTICIPANTS_DATA, PacketIDs.CAR_STATUS_DATA,
+    )
+
+    # Per car fields that are compared between packets for the change feed
+    WATCH_FIELDS = watch_fields_from_config({
+        PacketIDs.LAP_DATA: ("m_lapData", ("m_carPosition", "m_currentLapNum", "m_pitStatus")),
+        PacketIDs.CAR_STATUS_DATA: ("m_carStatusData", ("m_visualTyreCompound",)),
+    })
+
+    # Packet types that the game sends every frame (at the configured send rate),
+    # gaps in their frame identifiers indicate lost packets
+    PER_FRAME_PACKET_IDS = (
+        PacketIDs.MOTION_DATA, PacketIDs.LAP_DATA,
+        PacketIDs.CAR_TELEMETRY_DATA, PacketIDs.CAR_STATUS_DATA,
+    )
+
+    def __init__(self, event_handlers=None, change_handlers=None, watch_fields=None, clock=time.time):
+        """
+        event_handlers: a dict that maps event string codes to lists of handler
+                    functions, which are called with the session and the event
+                    packet whenever such an event is received
+
+        change_handlers: a list of handler functions for the change feed (see
+                    F1SessionManager.add_change_handler)
+
+        watch_fields: per car fields that are compared between packets for the
+                    change feed, as dict {packet_id: (array_name, fields)}.
+                    If not provided: WATCH_FIELDS
+
+        clock: function that returns the current time in seconds (see F1SessionManager)
+        """
+
         self.motion_data = {}
         self.session_data = {}
         self.lap_data = {}
@@ -74,13 +190,24 @@ class F1Session:
             self.car_status_data, self.final_classification_data, self.lobby_info_data,
         ]
 
-        self._session_start_time = time.time()
+        self._clock = clock
+        self._session_start_time = clock()
         self._last_packet_received_time = None
         self._last_lobby_packet_received_time = None
 
         self.session_uid = None
         self.total_packets_reveived = 0
         self._players = {}
+        self._event_handlers = event_handlers if event_handlers is not None else {}
+        self._change_handlers = change_handlers if change_handlers is not None else []
+        self._watch_fields = watch_fields if watch_fields is not None else F1Session.WATCH_FIELDS
+        self._ended = False
+
+        # Health counters
+        self.out_of_order_discards = 0
+        self._last_frames = {}
+        self._frame_steps = {}
+        self._lost_packets = {}
 
 
     def is_in_lobby(self) -> bool:
@@ -92,7 +219,7 @@ class F1Session:
 
         in_lobby = self._last_lobby_packet_received_time != None
         if in_lobby:
-            time_diff = time.time() - self._last_lobby_packet_received_time
+            time_diff = self._clock() - self._last_lobby_packet_received_time
             in_lobby = in_lobby and (time_diff < F1Session.LOBBY_PACKET_TIMEOUT)
         return in_lobby
     
@@ -101,12 +228,13 @@ class F1Session:
         """
         Returns True if the session is active, False if not.
         If for SESSION_ACTIVE_TIMOUT seconds no packet is received,
-        the session is considered to be inactive
+        or if the game announced the end of the session, the session
+        is considered to be inactive
         """
 
-        if self._last_packet_received_time == None:
+        if self._ended or self._last_packet_received_time == None:
             return False
-        return (time.time() - self._last_packet_received_time) < F1Session.SESSION_ACTIVE_TIMEOUT
+        return (self._clock() - self._last_packet_received_time) < F1Session.SESSION_ACTIVE_TIMEOUT
 
 
     def has_best_lap_data(self) -> bool:
@@ -115,10 +243,8 @@ class F1Session:
         to determine best lap times for the session, False if not
         """
 
-        if len(self.session_data.keys()) == 0: return False
-        if len(self.car_status_data.keys()) == 0: return False
-        if len(self.lap_data.keys()) == 0: return False
-        if len(self.participants_data.keys()) == 0: return False
+        for packet_id in F1Session.BEST_LAP_PACKET_IDS:
+            if len(self._id_to_packet_list[packet_id].keys()) == 0: return False
         return True
 
     
@@ -155,13 +281,24 @@ class F1Session:
         frame_id = packet["header"]["m_frameIdentifier"]
         
         # Discard packet if present packet is newer
-        if player_car_id in self._id_to_packet_list[packet_id].keys():
-            if self._id_to_packet_list[packet_id][player_car_id]["header"]["m_frameIdentifier"] > frame_id:
+        previous_packet = self._id_to_packet_list[packet_id].get(player_car_id)
+        if previous_packet is not None:
+            if previous_packet["header"]["m_frameIdentifier"] > frame_id:
+                self.out_of_order_discards += 1
                 return
 
+        if packet_id in F1Session.PER_FRAME_PACKET_IDS:
+            self._detect_frame_gap(player_car_id, packet_id, frame_id)
+
         # Store the packet in the right place
         self._id_to_packet_list[packet_id][player_car_id] = packet
 
+        if previous_packet is not None and self._change_handlers and packet_id in self._watch_fields:
+            changes = self.detect_changes(packet_id, previous_packet, packet)
+            if changes:
+                for handler in self._change_handlers:
+                    handler(self, packet, changes)
+
         # If the packet is a PARTICIPANTS_DATA packet, extract information about players
         if packet["header"]["m_packetId"] == PacketIDs.PARTICIPANTS_DATA:
             player_car_id = packet["header"]["m_playerCarIndex"]
@@ -173,7 +310,91 @@ class F1Session:
             }
         
         self.total_packets_reveived += 1
-        self._last_packet_received_time = time.time()
+        self._last_packet_received_time = self._clock()
+
+        if packet_id == PacketIDs.EVENT_DATA:
+            self._handle_event(packet)
+
+
+    def _detect_frame_gap(self, player_car_id: int, packet_id: int, frame_id: int) -> None:
+        """
+        Estimates lost packets from gaps in the frame identifiers of packets that
+        are sent every frame. If the game sends at less than its frame rate,
+        frames are skipped regularly, so the smallest step between two packets
+        is taken as send interval
+        """
+
+        key = (player_car_id, packet_id)
+        last_frame = self._last_frames.get(key)
+        self._last_frames[key] = frame_id
+        if last_frame is None:
+            return
+        step = frame_id - last_frame
+        if step <= 0:
+            return
+
+        interval = self._frame_steps.get(key)
+        if interval is None or step < interval:
+            self._frame_steps[key] = step
+            return
+        lost = step // interval - 1
+        if lost > 0:
+            self._lost_packets[player_car_id] = self._lost_packets.get(player_car_id, 0) + lost
+
+
+    def health(self) -> dict:
+        """
+        Returns a snapshot of the health counters of the session: received packets,
+        packets discarded because a newer packet was present, and the estimated
+        number of lost packets per player car index
+        """
+
+        return {
+            "packets_received": self.total_packets_reveived,
+            "out_of_order_discards": self.out_of_order_discards,
+            "estimated_lost_packets": self._lost_packets.copy(),
+        }
+
+
+    def detect_changes(self, packet_id: int, previous_packet, packet) -> list:
+        """
+        Compares the watched per car fields of two packets of the given type.
+
+        Returns: a list of (car, field, old, new) tuples for all changed fields
+        """
+
+        array_name, fields = self._watch_fields[packet_id]
+        previous_cars = previous_packet["content"][array_name]
+        cars = packet["content"][array_name]
+        changes = []
+        for car in range(len(cars)):
+            old_data = previous_cars[car]
+            new_data = cars[car]
+            # Records are tuples, so unchanged cars are skipped by a single comparison
+            if old_data is new_data or old_data == new_data:
+                continue
+            for field in fields:
+                old_value = old_data[field]
+                new_value = new_data[field]
+                if old_value != new_value:
+                    changes.append((car, field, old_value, new_value))
+        return changes
+
+
+    def _handle_event(self, packet) -> None:
+        """
+        Tracks session start and end and calls the handlers registered for
+        the event code of the packet
+        """
+
+        event_code = packet["content"]["m_eventStringCode"]
+        if event_code == EventCodes.SESSION_STARTED:
+            self._ended = False
+        elif event_code == EventCodes.SESSION_ENDED:
+            self._ended = True
+
+        for handler in self._event_handlers.get(event_code, ()):
+            handler(self, packet)
 
 
     def query(self, car_id: int, packet_id: int, query: str):
@@ -50,13 +50,13 @@ struct_PacketMotionData = [
     ("float*4", "m_wheelSlip"),
     ("float", "m_localVelocityX"),
     ("float", "m_localVelocityY"),
-    ("float", "m_localVelocityX"),
+    ("float", "m_localVelocityZ"),
     ("float", "m_angularVelocityX"),
     ("float", "m_angularVelocityY"),
-    ("float", "m_angularVelocityX"),
+    ("float", "m_angularVelocityZ"),
     ("float", "m_angularAccelerationX"),
     ("float", "m_angularAccelerationY"),
-    ("float", "m_angularAccelerationX"),
+    ("float", "m_angularAccelerationZ"),
     ("float", "m_frontWheelsAngle"),
 ]
 
@@ -138,6 +138,47 @@ struct_PacketLapData = [
     ("struct_LapData*22", "m_lapData"),
 ]
 
+# Structures for packet ID 3: Event
+# The event details are a union, which variant is used depends on the event
+# string code (see event_details below). m_eventDetails holds the raw bytes of
+# the union, which are as large as its largest variant
+struct_FastestLap = [
+    ("uint8", "vehicleIdx"),
+    ("float", "lapTime"),
+]
+
+struct_Retirement = [
+    ("uint8", "vehicleIdx"),
+]
+
+struct_TeamMateInPits = [
+    ("uint8", "vehicleIdx"),
+]
+
+struct_RaceWinner = [
+    ("uint8", "vehicleIdx"),
+]
+
+struct_Penalty = [
+    ("uint8", "penaltyType"),
+    ("uint8", "infringementType"),
+    ("uint8", "vehicleIdx"),
+    ("uint8", "otherVehicleIdx"),
+    ("uint8", "time"),
+    ("uint8", "lapNum"),
+    ("uint8", "placesGained"),
+]
+
+struct_SpeedTrap = [
+    ("uint8", "vehicleIdx"),
+    ("float", "speed"),
+]
+
+struct_PacketEventData = [
+    ("char*4", "m_eventStringCode"),
+    ("uint8*7", "m_eventDetails"),
+]
+
 # Structures for packet ID 4: Participants
 struct_ParticipantData = [
     ("uint8", "m_aiControlled"),
@@ -249,7 +290,7 @@ struct_CarStatusData = [
     ("uint8", "m_ersDeployMode"),
 
     ("float", "m_ersHarvestedThisLapMGUK"),
-    ("float", "m_ersHarvestedThisLapMGUK"),
+    ("float", "m_ersHarvestedThisLapMGUH"),
     ("float", "m_ersDeployedThisLap"),
 ]
 
@@ -295,11 +336,15 @@ struct_PacketLobbyInfoData = [
 ]
 
 
+# Value of m_packetFormat in the headers of packets with these structures
+packet_format = 2020
+
 # Top level package structures are linked to their packet IDs here
 packet_ids = {
     0: "struct_PacketMotionData",
     1: "struct_PacketSessionData",
     2: "struct_PacketLapData",
+    3: "struct_PacketEventData",
     4: "struct_PacketParticipantsData",
     5: "struct_PacketCarSetupData",
     6: "struct_PacketCarTelemetryData",
@@ -307,3 +352,18 @@ packet_ids = {
     8: "struct_PacketFinalClassificationData",
     9: "struct_PacketLobbyInfoData",
 }
+
+# Value of m_packetVersion per packet ID, it is 1 for all packets of this season
+packet_versions = {packet_id: 1 for packet_id in packet_ids.keys()}
+
+
+# Variants of the event details union are linked to their event string codes
+# here. Events without details are not listed
+event_details = {
+    "FTLP": "struct_FastestLap",
+    "RTMT": "struct_Retirement",
+    "TMPT": "struct_TeamMateInPits",
+    "RCWN": "struct_RaceWinner",
+    "PENA": "struct_Penalty",
+    "SPTP": "struct_SpeedTrap",
+}
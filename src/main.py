@@ -1,4 +1,8 @@
 import client
+import capture
+import decode_pool
+import async_client
+import best_laps
 import time
 import f1.f1decode as f1decode
 import f1.f1session as f1session
@@ -8,7 +12,8 @@ import os
 import json
 import config
 import traceback
-from f1.f1enums import PacketIDs
+import collections
+from f1.f1enums import PacketIDs, EventCodes
 
 def log(msg):
     global USE_STDOUT
@@ -20,9 +25,18 @@ def log(msg):
 CHECKING_INTERVAL = config.CONFIG.get("/client/checkingInterval", 1.0)
 USE_STDOUT = config.CONFIG.get("/client/stdout", False)
 PRINT_INCOMING_BEST_TIMES = config.CONFIG.get("/client/printIncomingBestTimes", False)
+RECEIVE_BATCH_SIZE = config.CONFIG.get("/client/receiveBatchSize", 0)
+RECEIVE_BUFFER_SIZE = config.CONFIG.get("/client/receiveBufferSize", 0)
+DECODE_WORKERS = config.CONFIG.get("/client/decodeWorkers", 0)
+LISTEN_ADDRESSES = [client.address_to_target(address) for address in
+    config.CONFIG.get("/client/listenAddresses", ["localhost:20777"])]
+ASYNC_RECEIVER = config.CONFIG.get("/client/asyncReceiver", False)
+CAPTURE_FILE = config.CONFIG.get("/client/captureFile")
 session_manager = f1session.F1SessionManager()
-current_best_times = {}
+best_lap_times = best_laps.BestLapTimes()
 pending_db_transactions = []
+# Fastest lap events received by the UDP thread, registered by the main loop
+pending_fastest_laps = collections.deque()
 log("Connecting to database...")
 db_connection = f1database.connect()
 log("Connected")
@@ -34,20 +48,7 @@ def register_best_time(session_uid, player_name, last_time, data):
     Times are registered per player, and players are registered per session.
     """
 
-    global current_best_times
-
-    new_best = False
-
-    if not session_uid in current_best_times.keys():
-        current_best_times[session_uid] = {}
-    if not player_name in current_best_times[session_uid].keys():
-        current_best_times[session_uid][player_name] = (last_time, data, False)
-        new_best = True
-    else:
-        saved_time = current_best_times[session_uid][player_name][0]
-        if last_time < saved_time:
-            new_best = True
-            current_best_times[session_uid][player_name] = (last_time, data, False)
+    new_best = best_lap_times.register(session_uid, player_name, last_time, data)
     
     if new_best and PRINT_INCOMING_BEST_TIMES:
         track_str = f1enumstrings.TrackIDs[data[1]]
@@ -61,20 +62,10 @@ def register_best_time(session_uid, player_name, last_time, data):
 
 
 def prepare_db_transactions():
-    global current_best_times, session_manager, pending_db_transactions
-
-    for session_uid in current_best_times.keys():
-        if not session_manager.sessions[session_uid].is_active():
-            best_times_data = current_best_times[session_uid]
-            for player in best_times_data.keys():
-                if best_times_data[player][2]:
-                    continue
+    global pending_db_transactions
 
-                db_data = best_times_data[player][1]
-                pending_db_transactions.append(db_data)
-                current_best_times[session_uid][player] = (
-                    best_times_data[player][0], best_times_data[player][1], True
-                )
+    pending_db_transactions += best_lap_times.take_finished(
+        lambda session_uid: session_manager.sessions[session_uid].is_active())
 
 
 def process_db_transactions_batch():
@@ -92,6 +83,25 @@ def process_db_transactions_batch():
     f1database.transaction(db_connection, sql)
 
 
+def fastest_lap_event_handler(session, packet):
+    """
+    Event handler for FTLP events. Runs on the UDP thread, so the lap is only
+    queued here and registered by the main loop
+    """
+
+    pending_fastest_laps.append((session, packet["header"]["m_playerCarIndex"], packet["content"]["m_eventDetails"]))
+
+
+def register_fastest_lap(session, car_id, details):
+    """
+    Register the lap of a fastest lap event as best time of the player who drove it
+    """
+
+    lap = best_laps.fastest_lap_time(session, car_id, details)
+    if lap is not None:
+        register_best_time(session.session_uid, *lap)
+
+
 def udp_packet_handler_callback(packet):
     """
     Packet handler for the UDP thread
@@ -99,50 +109,79 @@ def udp_packet_handler_callback(packet):
     
     session_manager.dispatch_packet(packet)
 
+
+def create_packet_queue():
+    """
+    Creates the priority queue between receiving and decoding from the config
+    (/client/loadShedding), or returns None if load shedding is disabled
+    """
+
+    if not config.CONFIG.get("/client/loadShedding/enabled", False):
+        return None
+
+    priorities = {}
+    rate_caps = {}
+    for name, packet_id in vars(PacketIDs).items():
+        if name.startswith("_"):
+            continue
+        priority = config.CONFIG.get("/client/loadShedding/priorities/%d" % packet_id)
+        if priority is not None:
+            priorities[packet_id] = priority
+        rate_cap = config.CONFIG.get("/client/loadShedding/rateCaps/%d" % packet_id)
+        if rate_cap is not None:
+            rate_caps[packet_id] = rate_cap
+
+    return client.PriorityPacketQueue(
+        capacity=config.CONFIG.get("/client/loadShedding/capacity", 4096),
+        priorities=priorities, rate_caps=rate_caps,
+        rate_cap_threshold=config.CONFIG.get("/client/loadShedding/rateCapThreshold", 0.0),
+    )
+
+
 log("Starting UDP client...")
-udp_thread = client.UDPThread(20777, packet_decoder=f1decode.decode_packet, packet_handler=udp_packet_handler_callback)
+session_manager.add_event_handler(EventCodes.FASTEST_LAP, fastest_lap_event_handler)
+# Only the asynchronous receiver listens on more than one address
+bind_address, udp_port = LISTEN_ADDRESSES[0]
+if len(LISTEN_ADDRESSES) > 1 and not ASYNC_RECEIVER:
+    log("Listening on %s:%d only, enable /client/asyncReceiver to listen on all addresses" % (bind_address, udp_port))
+capture_writer = None
+if CAPTURE_FILE:
+    log("Capturing received packets to '%s'" % CAPTURE_FILE)
+    capture_writer = capture.CaptureWriter(CAPTURE_FILE, config.CONFIG.get("/capture/capacity", 65536))
+if ASYNC_RECEIVER:
+    format_registry, packet_decoder, memo_decoder = best_laps.create_packet_decoder()
+    udp_thread = async_client.AsyncReceiverThread(async_client.AsyncUDPReceiver(LISTEN_ADDRESSES,
+        packet_decoder=format_registry, packet_handler=udp_packet_handler_callback,
+        receive_buffer_size=RECEIVE_BUFFER_SIZE, capture=capture_writer))
+elif DECODE_WORKERS > 0:
+    udp_thread = decode_pool.DecodePool(udp_port, decoder_factory=best_laps.create_worker_decoder,
+        packet_handler=udp_packet_handler_callback, workers=DECODE_WORKERS,
+        receive_buffer_size=RECEIVE_BUFFER_SIZE, address=bind_address, batch_size=RECEIVE_BATCH_SIZE or 64,
+        capture=capture_writer)
+else:
+    format_registry, packet_decoder, memo_decoder = best_laps.create_packet_decoder()
+    udp_thread = client.UDPThread(udp_port, packet_decoder=format_registry, packet_handler=udp_packet_handler_callback,
+        batch_size=RECEIVE_BATCH_SIZE, receive_buffer_size=RECEIVE_BUFFER_SIZE, address=bind_address,
+        packet_queue=create_packet_queue(), capture=capture_writer)
 udp_thread.start()
 log("Started")
 
 try:
     log("READY")
     while True:
+        # Register laps that the game announced as fastest laps
+        while len(pending_fastest_laps) > 0:
+            register_fastest_lap(*pending_fastest_laps.popleft())
+
         # Iterate over all sessions and query last lap times for each player. These times and associated
-        # data is then inserted into current_best_times if that player beat their prevous best time in
-        # their respective session
+        # data is then registered if that player beat their prevous best time in their respective session
         for session_uid in list(session_manager.sessions.keys()):
             session = session_manager.sessions[session_uid]
-
-            if not session.has_best_lap_data():
-                continue
-
-            current_times = session.query(0, PacketIDs.LAP_DATA,
-                "content/m_lapData[+]/m_lastLapTime")
-            
-            track_id = session.query(0, PacketIDs.SESSION_DATA,
-                "content/m_trackId")
-            session_type = session.query(0, PacketIDs.SESSION_DATA,
-                "content/m_sessionType")
-            
-            
-            for current_time in current_times:
-                player_name = current_time[0]["data"]["m_name"]
-                car_id = current_time[0]["carIndex"]
-                lap_time = current_time[1]
-                lap_time_pretty = f1decode.format_lap_time(current_time[1])
-                team_id = session.query(car_id, PacketIDs.PARTICIPANTS_DATA,
-                    "content/m_participants[@]/m_teamId")
-                tyre_id = session.query(car_id, PacketIDs.CAR_STATUS_DATA,
-                    "content/m_carStatusData[@]/m_visualTyreCompound")
-
-                # If no lap has been completed yet, the last lap time will be 0. Therefore we have
-                # to check for reasonable times
-                if lap_time > 10.0:
-                    register_best_time(session.session_uid, player_name, lap_time,
-                        (player_name, track_id, session_type, team_id, tyre_id, lap_time))
+            for player_name, lap_time, data in best_laps.collect_lap_times(session):
+                register_best_time(session.session_uid, player_name, lap_time, data)
         
         
-        if len(current_best_times.keys()) > 0:
+        if len(best_lap_times.best_times.keys()) > 0:
             prepare_db_transactions()
         if len(pending_db_transactions) > 0:
             log("Processing %d pending database transaction(s)..." % len(pending_db_transactions))
@@ -159,6 +198,20 @@ except Exception as err:
 finally:
     log("Shutting down UDP client...")
     udp_thread.stop()
+    if DECODE_WORKERS > 0 and not ASYNC_RECEIVER:
+        log("Dropped %d packet(s) because all decode slots were in use" % udp_thread.dropped_count)
+    else:
+        log("Decoded %d packet(s), skipped per packet ID: %s" % (
+            packet_decoder.decoded_count, packet_decoder.skip_counts()
+        ))
+        log("Memoized packet contents: %s" % memo_decoder.stats())
+        log("Rejected packets of unsupported formats per source: %s" % format_registry.rejected_counts)
+    if isinstance(udp_thread, client.UDPThread):
+        log("Ingest health: %s" % udp_thread.health())
+    if capture_writer is not None:
+        capture_writer.close()
+        log("Capture: %s" % capture_writer.stats())
+    log("Session health: %s" % session_manager.health())
     log("Disconnecting from database...")
     f1database.disconnect(db_connection)
     log("Disconnected")
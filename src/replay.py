@@ -0,0 +1,275 @@
+import sys
+import time
+import socket
+import collections
+import client
+import config
+import capture
+import best_laps
+import f1.f1session as f1session
+from f1.f1enums import EventCodes
+
+CHECKING_INTERVAL = config.CONFIG.get("/client/checkingInterval", 1.0)
+RECEIVE_BATCH_SIZE = config.CONFIG.get("/client/receiveBatchSize", 0)
+RECEIVE_BUFFER_SIZE = config.CONFIG.get("/client/receiveBufferSize", 0)
+REPLAY_SPEED = config.CONFIG.get("/replay/speed", 0)
+REPLAY_UDP_PORT = config.CONFIG.get("/replay/udpPort", 20787)
+
+# Time in seconds without new datagrams after which a udp replay is finished
+UDP_IDLE_TIMEOUT = 1.0
+
+
+class BestLapReplay:
+    """
+    The packet pipeline of main.py without the database: datagrams are decoded by
+    the decoder of best_laps.create_packet_decoder, dispatched to a session manager,
+    and the best lap logic of the main loop runs every checking_interval seconds of
+    capture time. The sessions use the capture time as their clock, so session
+    timeouts happen as they did when the capture was recorded, independent of the
+    replay speed. Finished best times are collected instead of being written to the
+    database.
+    """
+
+    def __init__(self, checking_interval=CHECKING_INTERVAL):
+        self.format_registry, self.packet_decoder, self.memo_decoder = best_laps.create_packet_decoder()
+        # Capture time of the sessions in nanoseconds
+        self.capture_time = 0
+        # Capture time of the last datagram a udp replay has sent
+        self.sent_time = 0
+        self.session_manager = f1session.F1SessionManager(clock=self.clock)
+        self.session_manager.add_event_handler(EventCodes.FASTEST_LAP, self._fastest_lap_event_handler)
+        self.best_lap_times = best_laps.BestLapTimes()
+        self.pending_fastest_laps = collections.deque()
+        self.checking_interval_ns = int(checking_interval * 1e9)
+        self.next_check = None
+        self.new_best_times = 0
+        self.finished = []
+
+    def clock(self) -> float:
+        """
+        The clock of the sessions: the capture time in seconds
+        """
+
+        return self.capture_time / 1e9
+
+    def _fastest_lap_event_handler(self, session, packet):
+        self.pending_fastest_laps.append(
+            (session, packet["header"]["m_playerCarIndex"], packet["content"]["m_eventDetails"]))
+
+    def handle_datagram(self, datagram, addr) -> None:
+        """
+        Decodes and dispatches a datagram, like client.UDPThread does
+        """
+
+        packet = self.format_registry(datagram, source=addr)
+        if packet is not None:
+            self.session_manager.dispatch_packet(packet)
+
+    def process(self, record) -> None:
+        """
+        Handles a (timestamp_ns, addr, datagram) record of a capture and runs the
+        main loop checks when they are due
+        """
+
+        timestamp, addr, datagram = record
+        self.check_due(timestamp)
+        self.capture_time = timestamp
+        self.handle_datagram(datagram, addr)
+
+    def handle_packet(self, packet) -> None:
+        """
+        Packet handler for a client.UDPThread: dispatches a decoded packet and runs
+        the main loop checks when they are due, on the receiving thread, so they only
+        see packets that have arrived. sent_time has to be kept up to date by the
+        sender
+        """
+
+        sent_time = self.sent_time
+        self.check_due(sent_time)
+        self.capture_time = sent_time
+        self.session_manager.dispatch_packet(packet)
+
+    def check_due(self, timestamp) -> None:
+        """
+        Runs the main loop checks that are due before the capture time timestamp
+        (in nanoseconds). During gaps without datagrams, the main loop would have
+        checked every checking_interval, only the last of these checks is run: it
+        is the one that sees the longest time since the last packet.
+        """
+
+        if self.next_check is None:
+            self.next_check = timestamp + self.checking_interval_ns
+        elif timestamp >= self.next_check:
+            missed = (timestamp - self.next_check) // self.checking_interval_ns
+            check_time = self.next_check + missed * self.checking_interval_ns
+            self.capture_time = check_time
+            self.check()
+            self.next_check = check_time + self.checking_interval_ns
+
+    def _register(self, session_uid, lap) -> None:
+        if self.best_lap_times.register(session_uid, *lap):
+            self.new_best_times += 1
+
+    def check(self, ended=False) -> None:
+        """
+        One pass of the main loop of main.py. If ended is True, all sessions are
+        considered inactive, so all remaining best times are taken
+        """
+
+        while len(self.pending_fastest_laps) > 0:
+            session, car_id, details = self.pending_fastest_laps.popleft()
+            lap = best_laps.fastest_lap_time(session, car_id, details)
+            if lap is not None:
+                self._register(session.session_uid, lap)
+
+        for session_uid, session in list(self.session_manager.sessions.items()):
+            for lap in best_laps.collect_lap_times(session):
+                self._register(session_uid, lap)
+
+        sessions = self.session_manager.sessions
+        self.finished += self.best_lap_times.take_finished(
+            lambda session_uid: not ended and sessions[session_uid].is_active())
+
+
+def paced(records, speed):
+    """
+    Yields the records of a capture at the pace at which they were recorded,
+    speed times faster. With a speed of 0, records are yielded as fast as possible
+    """
+
+    start = time.monotonic()
+    first = None
+    for record in records:
+        if speed > 0:
+            if first is None:
+                first = record[0]
+            delay = start + (record[0] - first) / 1e9 / speed - time.monotonic()
+            if delay > 0.001:
+                time.sleep(delay)
+        yield record
+
+
+def _report(replay, datagrams, total_bytes, first, last, elapsed) -> dict:
+    capture_duration = (last - first) / 1e9 if datagrams > 0 else 0.0
+    return {
+        "datagrams": datagrams,
+        "bytes": total_bytes,
+        "capture_duration": capture_duration,
+        "elapsed": elapsed,
+        "datagrams_per_second": datagrams / elapsed if elapsed > 0 else 0.0,
+        "speedup": capture_duration / elapsed if elapsed > 0 else 0.0,
+        "sessions": len(replay.session_manager.sessions),
+        "new_best_times": replay.new_best_times,
+        "finished_best_times": len(replay.finished),
+    }
+
+
+def replay_in_process(records, speed=0) -> dict:
+    """
+    Replays capture records directly into the packet pipeline (see BestLapReplay)
+
+    Returns: a throughput report
+    """
+
+    replay = BestLapReplay()
+    datagrams = 0
+    total_bytes = 0
+    first = last = None
+    start = time.perf_counter()
+    for record in paced(records, speed):
+        replay.process(record)
+        datagrams += 1
+        total_bytes += len(record[2])
+        first = record[0] if first is None else first
+        last = record[0]
+    replay.check(ended=True)
+    elapsed = time.perf_counter() - start
+
+    report = _report(replay, datagrams, total_bytes, first, last, elapsed)
+    report["replay"] = replay
+    return report
+
+
+def replay_udp(records, speed=0, port=REPLAY_UDP_PORT) -> dict:
+    """
+    Replays capture records over localhost udp into a client.UDPThread that runs
+    the packet pipeline (see BestLapReplay). Datagrams that the receiving side
+    drops are reported as lost. The capture time of the sessions is the time of
+    the last sent datagram, so received packets are stamped as late as the receive
+    queue lags behind.
+
+    Returns: a throughput report
+    """
+
+    replay = BestLapReplay()
+    udp_thread = client.UDPThread(port, packet_decoder=replay.format_registry,
+        packet_handler=replay.handle_packet, batch_size=RECEIVE_BATCH_SIZE,
+        receive_buffer_size=RECEIVE_BUFFER_SIZE, address="127.0.0.1")
+    udp_thread.start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target = ("127.0.0.1", port)
+
+    datagrams = 0
+    total_bytes = 0
+    first = last = None
+    start = time.perf_counter()
+    try:
+        for timestamp, addr, datagram in paced(records, speed):
+            replay.sent_time = timestamp
+            sender.sendto(datagram, target)
+            datagrams += 1
+            total_bytes += len(datagram)
+            first = timestamp if first is None else first
+            last = timestamp
+
+        # Wait until the receiving thread has received everything that arrived, the
+        # replay ends with the last received datagram
+        received = udp_thread.stats.snapshot()["datagrams"]
+        last_progress = time.perf_counter()
+        while received < datagrams and time.perf_counter() - last_progress < UDP_IDLE_TIMEOUT:
+            time.sleep(0.01)
+            if udp_thread.stats.snapshot()["datagrams"] != received:
+                received = udp_thread.stats.snapshot()["datagrams"]
+                last_progress = time.perf_counter()
+        elapsed = last_progress - start
+    finally:
+        udp_thread.stop()
+        sender.close()
+    replay.check(ended=True)
+
+    report = _report(replay, datagrams, total_bytes, first, last, elapsed)
+    report["received"] = udp_thread.stats.snapshot()["datagrams"]
+    report["lost"] = datagrams - report["received"]
+    report["replay"] = replay
+    return report
+
+
+if __name__ == "__main__":
+    # Usage: replay.py <capture file> [--speed=N] [--udp]
+    # --speed=1 replays in real time, --speed=10 ten times faster, --speed=0 (the
+    # default, see /replay/speed) as fast as possible. With --udp, the datagrams are
+    # sent over localhost udp to a UDPThread instead of into the decoder directly
+    if len(sys.argv) < 2:
+        print("Usage: %s <capture file> [--speed=N] [--udp]" % sys.argv[0])
+        exit(1)
+
+    speed = REPLAY_SPEED
+    for arg in sys.argv[2:]:
+        if arg.startswith("--speed="):
+            speed = float(arg.split("=")[1])
+
+    records = capture.read_capture(sys.argv[1])
+    if "--udp" in sys.argv:
+        report = replay_udp(records, speed)
+    else:
+        report = replay_in_process(records, speed)
+
+    replay = report.pop("replay")
+    print("Replayed %d datagram(s) (%.1f s of capture) in %.2f s: %.0f datagrams/s, %.1fx real time" % (
+        report["datagrams"], report["capture_duration"], report["elapsed"],
+        report["datagrams_per_second"], report["speedup"]))
+    if "lost" in report:
+        print("Lost %d datagram(s) on the way to the UDP thread" % report["lost"])
+    print("%d session(s), %d new best time(s), %d best time(s) for the database" % (
+        report["sessions"], report["new_best_times"], report["finished_best_times"]))
+    print("Session health: %s" % replay.session_manager.health())
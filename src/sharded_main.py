@@ -0,0 +1,154 @@
+import os
+import time
+import queue
+import traceback
+import collections
+import multiprocessing
+import client
+import config
+import best_laps
+import f1.f1decode as f1decode
+import f1.f1session as f1session
+import f1.f1database as f1database
+from f1.f1enums import EventCodes
+
+# Runs the best lap client in several listener processes that share the client port
+# with SO_REUSEPORT. Each worker keeps the sessions of the sources the kernel assigns
+# to it and reports new best times and its active sessions to the coordinator (this
+# process), which merges them and writes finished sessions to the database.
+
+def log(msg):
+    if not USE_STDOUT:
+        return
+    timestamp = time.strftime("[%d.%m.%y %H:%M:%S]")
+    print(timestamp, msg)
+
+CHECKING_INTERVAL = config.CONFIG.get("/client/checkingInterval", 1.0)
+USE_STDOUT = config.CONFIG.get("/client/stdout", False)
+RECEIVE_BATCH_SIZE = config.CONFIG.get("/client/receiveBatchSize", 0)
+RECEIVE_BUFFER_SIZE = config.CONFIG.get("/client/receiveBufferSize", 0)
+# The listener processes share the first of the listen addresses
+BIND_ADDRESS, UDP_PORT = client.address_to_target(config.CONFIG.get("/client/listenAddresses", ["localhost:20777"])[0])
+LISTENER_PROCESSES = config.CONFIG.get("/client/listenerProcesses", 0) or os.cpu_count()
+
+
+def run_worker(worker_id, reports, should_end):
+    """
+    Main function of the listener processes. Every CHECKING_INTERVAL seconds, a
+    (worker_id, active_session_uids, new_best_times) report is sent to the coordinator,
+    new_best_times is a list of (session_uid, player_name, lap_time, data) tuples
+    """
+
+    session_manager = f1session.F1SessionManager()
+    fastest_laps = collections.deque()
+    session_manager.add_event_handler(EventCodes.FASTEST_LAP, lambda session, packet: fastest_laps.append(
+        (session, packet["header"]["m_playerCarIndex"], packet["content"]["m_eventDetails"])))
+
+    format_registry = best_laps.create_packet_decoder()[0]
+    udp_thread = client.UDPThread(UDP_PORT, packet_decoder=format_registry,
+        packet_handler=session_manager.dispatch_packet, batch_size=RECEIVE_BATCH_SIZE,
+        receive_buffer_size=RECEIVE_BUFFER_SIZE, address=BIND_ADDRESS, reuse_port=True)
+    udp_thread.start()
+
+    # Only times that beat the best times this worker has seen are reported
+    best_lap_times = best_laps.BestLapTimes()
+    try:
+        while not should_end.is_set():
+            new_best_times = []
+            while len(fastest_laps) > 0:
+                session, car_id, details = fastest_laps.popleft()
+                lap = best_laps.fastest_lap_time(session, car_id, details)
+                if lap is not None and best_lap_times.register(session.session_uid, *lap):
+                    new_best_times.append((session.session_uid,) + lap)
+
+            active_sessions = []
+            for session_uid, session in list(session_manager.sessions.items()):
+                for lap in best_laps.collect_lap_times(session):
+                    if best_lap_times.register(session_uid, *lap):
+                        new_best_times.append((session_uid,) + lap)
+                if session.is_active():
+                    active_sessions.append(session_uid)
+
+            reports.put((worker_id, active_sessions, new_best_times))
+            should_end.wait(CHECKING_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        udp_thread.stop()
+
+
+class Coordinator:
+    """
+    Merges the reports of all listener processes. A session is active as long as at
+    least one worker reports it as active, the best times of a session are only taken
+    for the database when no worker does
+    """
+
+    def __init__(self, worker_count):
+        self.best_lap_times = best_laps.BestLapTimes()
+        self._active_sessions = [set() for i in range(worker_count)]
+
+    def is_active(self, session_uid) -> bool:
+        for active_sessions in self._active_sessions:
+            if session_uid in active_sessions:
+                return True
+        return False
+
+    def merge_report(self, worker_id, active_sessions, new_best_times) -> None:
+        self._active_sessions[worker_id] = set(active_sessions)
+        for session_uid, player_name, lap_time, data in new_best_times:
+            if self.best_lap_times.register(session_uid, player_name, lap_time, data):
+                log("New best time in session %d: %s (%s)" % (
+                    session_uid, player_name, f1decode.format_lap_time(lap_time)))
+
+    def take_finished(self) -> list:
+        return self.best_lap_times.take_finished(self.is_active)
+
+
+if __name__ == "__main__":
+    log("Connecting to database...")
+    db_connection = f1database.connect()
+    log("Connected")
+
+    log("Starting %d listener process(es)..." % LISTENER_PROCESSES)
+    reports = multiprocessing.Queue()
+    should_end = multiprocessing.Event()
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(worker_id, reports, should_end), daemon=True)
+        for worker_id in range(LISTENER_PROCESSES)
+    ]
+    for worker in workers:
+        worker.start()
+    coordinator = Coordinator(LISTENER_PROCESSES)
+    log("READY")
+
+    try:
+        while True:
+            try:
+                coordinator.merge_report(*reports.get(timeout=CHECKING_INTERVAL))
+            except queue.Empty:
+                pass
+
+            finished = coordinator.take_finished()
+            if len(finished) > 0:
+                log("Processing %d pending database transaction(s)..." % len(finished))
+                sql = ""
+                for data_entry in finished:
+                    sql += f1database.generate_best_lap_data_sql_statement(data_entry) + "\n"
+                f1database.transaction(db_connection, sql)
+                log("Database transactions committed")
+
+    except KeyboardInterrupt:
+        log("Keyboard Interrupt: Shutting down")
+    except Exception as err:
+        print("Coordinator Error:", err)
+        traceback.print_exc()
+
+    finally:
+        log("Shutting down listener processes...")
+        should_end.set()
+        for worker in workers:
+            worker.join()
+        log("Disconnecting from database...")
+        f1database.disconnect(db_connection)
+        log("Disconnected")
@@ -0,0 +1,207 @@
+import time
+import random
+import socket
+import config
+import f1.f1decode as f1decode
+from client import address_to_target
+from f1.f1enums import PacketIDs, EventCodes
+
+TARGETS = config.CONFIG.get("/trafficGenerator/targets", ["localhost:20777"])
+SESSION_COUNT = config.CONFIG.get("/trafficGenerator/sessions", 3)
+CAR_COUNT = config.CONFIG.get("/trafficGenerator/cars", 20)
+RATE = config.CONFIG.get("/trafficGenerator/rate", 60)
+MULTIPLIER = config.CONFIG.get("/trafficGenerator/multiplier", 1.0)
+DURATION = config.CONFIG.get("/trafficGenerator/duration", 0)
+
+# Packets per second that the game sends for packet types which are not sent
+# at the configured rate
+SESSION_DATA_RATE = 2
+PARTICIPANTS_DATA_RATE = 0.2
+
+
+def empty_packet(packet_id: int) -> dict:
+    """
+    Returns a packet with the given packet ID in which every value is zero
+    """
+
+    size = f1decode.get_packet_codec(packet_id).size
+    datagram = bytearray(size)
+    f1decode.PACKET_ID_STRUCT.pack_into(datagram, 0, packet_id)
+    return f1decode.decode_packet(datagram)
+
+
+class SimulatedSession:
+    """
+    Simulates the packets of one online session in which every car is driven
+    by a player, so every car sends its own packet stream (with its own
+    m_playerCarIndex) like a game client does
+    """
+
+    def __init__(self, session_uid: int, car_count: int, rate: int, rng):
+        self.session_uid = session_uid
+        self.car_count = car_count
+        self.rate = rate
+        self.frame = 0
+        self._rng = rng
+        self._templates = {
+            packet_id: empty_packet(packet_id) for packet_id in (
+                PacketIDs.MOTION_DATA, PacketIDs.SESSION_DATA, PacketIDs.LAP_DATA,
+                PacketIDs.EVENT_DATA, PacketIDs.PARTICIPANTS_DATA,
+                PacketIDs.CAR_TELEMETRY_DATA, PacketIDs.CAR_STATUS_DATA,
+            )
+        }
+        self._best_lap_time = None
+        self._cars = [{
+            "lap": 1,
+            "lapTime": 0.0,
+            "lapLength": rng.uniform(80.0, 95.0),
+            "lastLapTime": 0.0,
+        } for i in range(car_count)]
+
+    def _header(self, packet_id: int, car_index: int):
+        return self._templates[packet_id]["header"]._replace(
+            m_packetFormat=2020, m_gameMajorVersion=1, m_gameMinorVersion=18,
+            m_packetVersion=1, m_sessionUID=self.session_uid,
+            m_sessionTime=self.frame / self.rate, m_frameIdentifier=self.frame,
+            m_playerCarIndex=car_index, m_secondaryPlayerCarIndex=255,
+        )
+
+    def _for_all_cars(self, packet_id: int, content) -> list:
+        """
+        Encodes the content once and returns one datagram per car, each with
+        that cars header
+        """
+
+        datagram = f1decode.encode_packet({"header": self._header(packet_id, 0), "content": content})
+        content_bytes = datagram[f1decode.HEADER_CODEC.size:]
+        return [
+            f1decode.HEADER_CODEC.pack(self._header(packet_id, car_index)) + content_bytes
+            for car_index in range(self.car_count)
+        ]
+
+    def _session_data(self):
+        return self._templates[PacketIDs.SESSION_DATA]["content"]._replace(
+            m_trackId=10, m_sessionType=10, m_totalLaps=50, m_networkGame=1)
+
+    def _participants_data(self):
+        template = self._templates[PacketIDs.PARTICIPANTS_DATA]["content"]
+        participants = list(template["m_participants"])
+        for i in range(self.car_count):
+            participants[i] = participants[i]._replace(
+                m_aiControlled=0, m_driverId=100 + i, m_teamId=i % 10, m_raceNumber=i + 2,
+                m_nationality=1 + i, m_name="Player %02d" % i)
+        return template._replace(m_numActiveCars=self.car_count, m_participants=participants)
+
+    def _lap_data(self):
+        template = self._templates[PacketIDs.LAP_DATA]["content"]
+        lap_data = list(template["m_lapData"])
+        for i, car in enumerate(self._cars):
+            lap_data[i] = lap_data[i]._replace(
+                m_lastLapTime=car["lastLapTime"], m_currentLapTime=car["lapTime"],
+                m_currentLapNum=car["lap"], m_carPosition=i + 1, m_gridPosition=i + 1,
+                m_lapDistance=5000.0 * car["lapTime"] / car["lapLength"], m_driverStatus=1)
+        return template._replace(m_lapData=lap_data)
+
+    def _car_telemetry_data(self):
+        template = self._templates[PacketIDs.CAR_TELEMETRY_DATA]["content"]
+        telemetry = list(template["m_carTelemetryData"])
+        for i in range(self.car_count):
+            telemetry[i] = telemetry[i]._replace(
+                m_speed=self._rng.randint(80, 330), m_throttle=self._rng.random(), m_gear=self._rng.randint(1, 8))
+        return template._replace(m_carTelemetryData=telemetry)
+
+    def _car_status_data(self):
+        template = self._templates[PacketIDs.CAR_STATUS_DATA]["content"]
+        status = list(template["m_carStatusData"])
+        for i in range(self.car_count):
+            status[i] = status[i]._replace(m_visualTyreCompound=16 + i % 3, m_actualTyreCompound=16 + i % 3)
+        return template._replace(m_carStatusData=status)
+
+    def _event(self, event_code: str, details=None):
+        return self._templates[PacketIDs.EVENT_DATA]["content"]._replace(
+            m_eventStringCode=event_code, m_eventDetails=details)
+
+    def tick(self) -> list:
+        """
+        Advances the session by one frame
+
+        Returns: the datagrams of all cars for that frame
+        """
+
+        datagrams = []
+        if self.frame == 0:
+            datagrams += self._for_all_cars(PacketIDs.EVENT_DATA, self._event(EventCodes.SESSION_STARTED))
+
+        # Advance laps, announce fastest laps
+        for i, car in enumerate(self._cars):
+            car["lapTime"] += 1.0 / self.rate
+            if car["lapTime"] >= car["lapLength"]:
+                car["lastLapTime"] = car["lapTime"]
+                car["lapTime"] = 0.0
+                car["lap"] += 1
+                car["lapLength"] = self._rng.uniform(80.0, 95.0)
+                if self._best_lap_time is None or car["lastLapTime"] < self._best_lap_time:
+                    self._best_lap_time = car["lastLapTime"]
+                    details = f1decode.record_type("struct_FastestLap")((i, car["lastLapTime"]))
+                    datagrams += self._for_all_cars(PacketIDs.EVENT_DATA, self._event(EventCodes.FASTEST_LAP, details))
+
+        if self.frame % int(self.rate / SESSION_DATA_RATE) == 0:
+            datagrams += self._for_all_cars(PacketIDs.SESSION_DATA, self._session_data())
+        if self.frame % int(self.rate / PARTICIPANTS_DATA_RATE) == 0:
+            datagrams += self._for_all_cars(PacketIDs.PARTICIPANTS_DATA, self._participants_data())
+        datagrams += self._for_all_cars(PacketIDs.MOTION_DATA, self._templates[PacketIDs.MOTION_DATA]["content"])
+        datagrams += self._for_all_cars(PacketIDs.LAP_DATA, self._lap_data())
+        datagrams += self._for_all_cars(PacketIDs.CAR_TELEMETRY_DATA, self._car_telemetry_data())
+        datagrams += self._for_all_cars(PacketIDs.CAR_STATUS_DATA, self._car_status_data())
+
+        self.frame += 1
+        return datagrams
+
+
+def run(targets: list, session_count: int, car_count: int, rate: int, multiplier: float, duration: float) -> None:
+    """
+    Sends the packets of session_count simulated sessions to all targets. rate
+    is the number of frames per second of the simulated game, multiplier speeds
+    up (or slows down) the simulated time. If duration is 0, packets are sent
+    until the process is interrupted.
+    """
+
+    rng = random.Random()
+    sessions = [SimulatedSession(rng.getrandbits(64), car_count, rate, rng) for i in range(session_count)]
+    out_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    interval = 1.0 / (rate * multiplier)
+
+    start = time.monotonic()
+    next_tick = start
+    next_report = start + 1.0
+    sent = 0
+    sent_since_report = 0
+    try:
+        while duration <= 0 or time.monotonic() - start < duration:
+            for session in sessions:
+                for datagram in session.tick():
+                    for target in targets:
+                        out_socket.sendto(datagram, target)
+                    sent_since_report += len(targets)
+
+            next_tick += interval
+            now = time.monotonic()
+            if now >= next_report:
+                print("Sent %d packets/s (frame %d)" % (sent_since_report / (now - next_report + 1.0), sessions[0].frame))
+                sent += sent_since_report
+                sent_since_report = 0
+                next_report = now + 1.0
+            if next_tick > now:
+                time.sleep(next_tick - now)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        out_socket.close()
+
+    sent += sent_since_report
+    elapsed = time.monotonic() - start
+    print("Sent %d packets in %.1f s (%.0f packets/s)" % (sent, elapsed, sent / elapsed if elapsed > 0 else 0))
+
+
+if __name__ == "__main__":
+    run([address_to_target(t) for t in TARGETS], SESSION_COUNT, CAR_COUNT, RATE, MULTIPLIER, DURATION)
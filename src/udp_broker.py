@@ -1,49 +1,550 @@
+import os
+import time
+import signal
 import socket
+import select
+import collections
 import config
+import capture
+from client import address_to_target
+from f1.f1enums import PacketIDs
 
 IN_PORT = 20778
-DEFAULT_PORT = 20777
-
-def address_to_target(address_str: str):
-    if ":" in address_str:
-        address = address_str.split(":")[0]
-        port = int(address_str.split(":")[1])
-    else:
-        address = address_str
-        port = DEFAULT_PORT
-    return (address, port)
-
-# load targets
-targets = []
-target_strings = config.CONFIG.get("/broker/targets")
-
-if not target_strings:
-    print("no targets defined")
-    exit(0)
-
-for t in target_strings:
-    targets.append(address_to_target(t))
-
-source = config.CONFIG.get("/broker/source", "localhost:20777")
-
-in_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-in_socket.bind(address_to_target(source))
-
-out_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-try:
-    while True:
-        # Read UDP packet
-        data, addr = in_socket.recvfrom(4096)
-        if not data:
-            break
-
-        for target in targets:
-            out_socket.sendto(data, target)
-
-except Exception as error:
-    print(error)
-    exit(1)
-finally:
-    in_socket.close()
-    out_socket.close()
+
+# Size of the receive buffers, large enough for every F1 packet
+MAX_DATAGRAM_SIZE = 4096
+
+# m_packetId is the 6th byte of the packet header
+PACKET_ID_OFFSET = 5
+
+# Defaults for all targets, can be set per target in /broker/targets
+QUEUE_SIZE = config.CONFIG.get("/broker/queueSize", 256)
+ERROR_BUDGET = config.CONFIG.get("/broker/errorBudget", 10)
+BACKOFF = config.CONFIG.get("/broker/backoff", 1.0)
+MAX_BACKOFF = config.CONFIG.get("/broker/maxBackoff", 30.0)
+
+# Length of the time window of the error budget in seconds
+ERROR_WINDOW = 1.0
+
+
+def packet_id_from_config(value) -> int:
+    """
+    Packet IDs can be configured as numbers or as names of f1enums.PacketIDs
+    """
+
+    if type(value) is str and not value.isdigit():
+        return getattr(PacketIDs, value)
+    return int(value)
+
+
+class BrokerTarget:
+    """
+    A target of the broker. Every target sends with its own non-blocking socket and
+    has its own bounded send queue, so a slow or failing target only drops its own
+    packets. Datagrams that can not be sent immediately are queued, if the queue is
+    full they are dropped. If more than error_budget sends fail within a second
+    (e.g. port unreachable), its queue is dropped and all packets for the target
+    are dropped for a backoff time, which doubles with every further backoff up to max_backoff. It is reset
+    once the target has been sent to for a second without errors.
+    Optionally, only packets with the allowed packet IDs are forwarded to the target,
+    and packets of some IDs are downsampled to a maximum rate. Both only look at the
+    packet ID in the header, packets are never decoded.
+    """
+
+    def __init__(self, address, packet_ids=None, max_rates=None, queue_size=None, error_budget=None,
+            backoff=None, max_backoff=None):
+        """
+        address: the (address, port) tuple of the target
+
+        packet_ids: the packet IDs that are forwarded
+                    If not provided: all packets are forwarded
+
+        max_rates: dict that maps packet IDs to the maximum number of packets per
+                    second that are forwarded, rates of 0 or less are not limited
+
+        queue_size, error_budget, backoff, max_backoff: see above, backoff times are
+                    in seconds
+                    If not provided: QUEUE_SIZE, ERROR_BUDGET, BACKOFF, MAX_BACKOFF
+        """
+
+        self.address = address
+        self.packet_ids = frozenset(packet_ids) if packet_ids is not None else None
+        self.min_intervals = {packet_id: 1.0 / rate for packet_id, rate in (max_rates or {}).items() if rate > 0}
+        self.is_filtered = self.packet_ids is not None or len(self.min_intervals) > 0
+        self._next_times = {}
+
+        self.queue_size = queue_size if queue_size is not None else QUEUE_SIZE
+        self.error_budget = error_budget if error_budget is not None else ERROR_BUDGET
+        self.initial_backoff = backoff if backoff is not None else BACKOFF
+        self.max_backoff = max_backoff if max_backoff is not None else MAX_BACKOFF
+        self._backoff = self.initial_backoff
+        self._backoff_until = 0.0
+        self._window_start = 0.0
+        self._window_errors = 0
+        self._last_error = 0.0
+
+        # The /broker/targets entry the target was created from
+        self.config_entry = None
+
+        self.socket = None
+        self.queue = collections.deque()
+        self.stats = {"packets": 0, "bytes": 0, "errors": 0, "filtered": 0, "dropped": 0}
+
+    @classmethod
+    def from_config(cls, entry):
+        """
+        Creates a target from an entry of /broker/targets, which is either an address
+        string or a dict like:
+            {"address": "host:port", "packetIds": ["LAP_DATA", 1], "maxRates": {"CAR_TELEMETRY_DATA": 10},
+             "queueSize": 256, "errorBudget": 10, "backoff": 1.0, "maxBackoff": 30.0}
+        """
+
+        if type(entry) is str:
+            target = cls(address_to_target(entry))
+        else:
+            packet_ids = entry.get("packetIds")
+            if packet_ids is not None:
+                packet_ids = [packet_id_from_config(packet_id) for packet_id in packet_ids]
+            max_rates = {packet_id_from_config(packet_id): rate for packet_id, rate in entry.get("maxRates", {}).items()}
+            target = cls(address_to_target(entry["address"]), packet_ids, max_rates, entry.get("queueSize"),
+                entry.get("errorBudget"), entry.get("backoff"), entry.get("maxBackoff"))
+        target.config_entry = entry
+        return target
+
+    def open(self) -> None:
+        """
+        Creates the non-blocking socket of the target
+        """
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        # Errors reported by the network for a connected socket (like port unreachable)
+        # only show up on this socket
+        self.socket.connect(self.address)
+
+    def close(self) -> None:
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def select(self, batch, packet_ids, now) -> list:
+        """
+        Selects the datagrams of a batch that are forwarded to this target.
+        packet_ids are the packet IDs of the datagrams, now is the time of the batch
+        (time.monotonic)
+        """
+
+        selected = []
+        for datagram, packet_id in zip(batch, packet_ids):
+            if self.packet_ids is not None and packet_id not in self.packet_ids:
+                continue
+            interval = self.min_intervals.get(packet_id)
+            if interval is not None:
+                next_time = self._next_times.get(packet_id, 0.0)
+                if now < next_time:
+                    continue
+                # Keep the average rate even if batches do not arrive exactly in time
+                self._next_times[packet_id] = next_time + interval if now - next_time < interval else now + interval
+            selected.append(datagram)
+        return selected
+
+    def send(self, datagrams, now) -> None:
+        """
+        Sends datagrams to the target, or queues them if the socket would block.
+        The datagrams may be views of reusable buffers, queued datagrams are copied.
+        """
+
+        if now < self._backoff_until:
+            self.stats["dropped"] += len(datagrams)
+            return
+
+        if self.queue:
+            self._enqueue(datagrams, 0)
+            self.flush(now)
+            return
+
+        send = self.socket.send
+        packets = 0
+        sent_bytes = 0
+        for i, datagram in enumerate(datagrams):
+            try:
+                sent_bytes += send(datagram)
+                packets += 1
+            except BlockingIOError:
+                self._enqueue(datagrams, i)
+                break
+            except OSError:
+                self.stats["dropped"] += 1
+                if self._on_error(now):
+                    self.stats["dropped"] += len(datagrams) - i - 1
+                    break
+        self._on_sent(packets, sent_bytes)
+
+    def flush(self, now) -> None:
+        """
+        Sends queued datagrams until the socket would block
+        """
+
+        if now < self._backoff_until:
+            return
+
+        queue = self.queue
+        send = self.socket.send
+        packets = 0
+        sent_bytes = 0
+        while queue:
+            try:
+                sent_bytes += send(queue[0])
+                packets += 1
+            except BlockingIOError:
+                break
+            except OSError:
+                queue.popleft()
+                self.stats["dropped"] += 1
+                if self._on_error(now):
+                    break
+                continue
+            queue.popleft()
+        self._on_sent(packets, sent_bytes)
+
+    def _enqueue(self, datagrams, start) -> None:
+        free = max(0, self.queue_size - len(self.queue))
+        end = min(len(datagrams), start + free)
+        self.queue.extend(bytes(datagram) for datagram in datagrams[start:end])
+        self.stats["dropped"] += len(datagrams) - end
+
+    def _on_sent(self, packets, sent_bytes) -> None:
+        if packets == 0:
+            return
+        self.stats["packets"] += packets
+        self.stats["bytes"] += sent_bytes
+
+    def _on_error(self, now) -> bool:
+        """
+        Counts a failed send. If the error budget is used up, the queued datagrams
+        are dropped, so they are not sent to the target during the backoff.
+
+        Returns: True if the error budget is used up and the target backs off
+        """
+
+        self.stats["errors"] += 1
+        # Packets are not sent during a backoff, so it does not count as time without errors
+        if now - max(self._last_error, self._backoff_until) >= ERROR_WINDOW:
+            self._backoff = self.initial_backoff
+        self._last_error = now
+        if now - self._window_start >= ERROR_WINDOW:
+            self._window_start = now
+            self._window_errors = 0
+        self._window_errors += 1
+        if self._window_errors <= self.error_budget:
+            return False
+        self._window_errors = 0
+        self._backoff_until = now + self._backoff
+        self.stats["dropped"] += len(self.queue)
+        self.queue.clear()
+        print("Target %s:%d exceeded its error budget, dropping its packets for %.1f s" % (
+            self.address[0], self.address[1], self._backoff))
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+        return True
+
+
+class FanoutEngine:
+    """
+    Forwards every datagram received on the input socket to all targets. The input
+    socket is drained in batches with recv_into on reusable buffers, then the whole
+    batch is handed to one target after the other, without copying the datagrams
+    (see BrokerTarget). Packets, bytes, send errors, filtered packets and dropped
+    packets are counted per target.
+    """
+
+    def __init__(self, in_socket, targets, batch_size=64, capture=None):
+        """
+        in_socket: the bound socket on which datagrams are received
+
+        targets: list of BrokerTarget, their sockets are opened by the engine
+
+        batch_size: the maximum number of datagrams that are received before they
+                    are forwarded
+
+        capture: a capture.CaptureWriter. If provided, every received datagram is
+                    recorded before it is forwarded
+        """
+
+        self._in_socket = in_socket
+        self._in_socket.setblocking(False)
+        self._buffers = [bytearray(MAX_DATAGRAM_SIZE) for i in range(batch_size)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+        self._capture = capture
+        self._should_end = False
+        self._pending_targets = None
+        self.targets = tuple(targets)
+        for target in self.targets:
+            target.open()
+        self.received_count = 0
+
+    def set_targets(self, targets) -> None:
+        """
+        Replaces the targets. The sockets of new targets are opened immediately, but
+        the target list is only swapped before the next batch, so no batch is sent to
+        a mix of old and new targets. Targets that are created from the same config
+        entry as a current target are replaced by the current target, so they keep
+        their counters and queued datagrams.
+        If a socket can not be opened (e.g. the address does not resolve), the sockets
+        opened so far are closed, the OSError is raised and the targets stay as they are.
+        """
+
+        current = {}
+        for target in self.targets:
+            if target.config_entry is not None:
+                current[repr(target.config_entry)] = target
+
+        new_targets = []
+        opened = []
+        try:
+            for target in targets:
+                kept = current.get(repr(target.config_entry)) if target.config_entry is not None else None
+                if kept is not None:
+                    new_targets.append(kept)
+                else:
+                    opened.append(target)
+                    target.open()
+                    new_targets.append(target)
+        except OSError:
+            for target in opened:
+                target.close()
+            raise
+
+        if self._pending_targets is not None:
+            for target in self._pending_targets:
+                if target not in self.targets:
+                    target.close()
+        self._pending_targets = tuple(new_targets)
+
+    def _swap_targets(self) -> None:
+        new_targets = self._pending_targets
+        self._pending_targets = None
+        for target in self.targets:
+            if target not in new_targets:
+                target.close()
+        self.targets = new_targets
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of the counters per target address
+        """
+
+        return {target.address: dict(target.stats, queued=len(target.queue)) for target in self.targets}
+
+    def receive_batch(self) -> list:
+        """
+        Receives all pending datagrams (up to the batch size) without blocking.
+
+        Returns: a list of memoryviews of the received datagrams, they are only valid
+        until the next batch is received
+        """
+
+        batch = []
+        if self._capture is not None:
+            # The source addresses are only needed for the capture
+            recvfrom_into = self._in_socket.recvfrom_into
+            tap = self._capture.tap
+            for buffer, view in zip(self._buffers, self._views):
+                try:
+                    size, addr = recvfrom_into(buffer)
+                except BlockingIOError:
+                    break
+                datagram = view[:size]
+                tap(datagram, addr)
+                batch.append(datagram)
+        else:
+            recv_into = self._in_socket.recv_into
+            for buffer, view in zip(self._buffers, self._views):
+                try:
+                    size = recv_into(buffer)
+                except BlockingIOError:
+                    break
+                batch.append(view[:size])
+        self.received_count += len(batch)
+        return batch
+
+    def send_batch(self, batch) -> None:
+        """
+        Sends a batch of datagrams to all targets
+        """
+
+        packet_ids = None
+        now = time.monotonic()
+        for target in self.targets:
+            datagrams = batch
+            if target.is_filtered:
+                if packet_ids is None:
+                    packet_ids = [datagram[PACKET_ID_OFFSET] if len(datagram) > PACKET_ID_OFFSET else None
+                        for datagram in batch]
+                datagrams = target.select(batch, packet_ids, now)
+                target.stats["filtered"] += len(batch) - len(datagrams)
+            target.send(datagrams, now)
+
+    def run_once(self, timeout=1.0) -> int:
+        """
+        Waits up to timeout seconds for datagrams and forwards one batch. Targets
+        with queued datagrams are flushed as soon as their sockets are writable.
+
+        Returns: the number of forwarded datagrams
+        """
+
+        if self._pending_targets is not None:
+            self._swap_targets()
+
+        pending = {target.socket: target for target in self.targets if target.queue}
+        readable, writable, _ = select.select([self._in_socket], list(pending.keys()), [], timeout)
+        if writable:
+            now = time.monotonic()
+            for sock in writable:
+                pending[sock].flush(now)
+        if not readable:
+            return 0
+        batch = self.receive_batch()
+        self.send_batch(batch)
+        return len(batch)
+
+    def run(self, reloader=None) -> None:
+        """
+        Forwards datagrams until stop is called. The reloader (TargetReloader) is
+        polled between batches.
+        """
+
+        while not self._should_end:
+            self.run_once()
+            if reloader is not None:
+                reloader.poll()
+
+    def stop(self) -> None:
+        self._should_end = True
+
+    def close(self) -> None:
+        """
+        Closes the sockets of all targets
+        """
+
+        for target in set(self.targets + (self._pending_targets or ())):
+            target.close()
+
+
+def load_targets(broker_config) -> list:
+    """
+    Creates the targets of /broker/targets of a config.Config
+    """
+
+    return [BrokerTarget.from_config(entry) for entry in broker_config.get("/broker/targets") or []]
+
+
+class TargetReloader:
+    """
+    Reloads the targets of a FanoutEngine when config.json or one of its additional
+    config files changes, or when a reload is requested (e.g. by SIGHUP). The files
+    are checked at most every interval seconds.
+    """
+
+    def __init__(self, engine, interval=1.0, filename=config.MAIN_CONFIG_FILE):
+        self._engine = engine
+        self._interval = interval
+        self._filename = filename
+        self._next_check = time.monotonic() + interval
+        self._requested = False
+        self._mtimes = self._read_mtimes(config.CONFIG.files)
+
+    def _read_mtimes(self, files) -> dict:
+        mtimes = {}
+        for filename in files:
+            try:
+                mtimes[filename] = os.stat(filename).st_mtime_ns
+            except OSError:
+                mtimes[filename] = None
+        return mtimes
+
+    def request(self, *args) -> None:
+        """
+        Requests a reload on the next poll, can be used as a signal handler
+        """
+
+        self._requested = True
+
+    def poll(self) -> bool:
+        """
+        Reloads the targets if requested or if a config file changed
+
+        Returns: True if the targets were reloaded
+        """
+
+        now = time.monotonic()
+        if not self._requested and now < self._next_check:
+            return False
+        self._next_check = now + self._interval
+
+        if not self._requested and self._read_mtimes(self._mtimes.keys()) == self._mtimes:
+            return False
+        self._requested = False
+
+        try:
+            new_config = config.load_config(self._filename)
+        except ValueError as err:
+            # E.g. a config file that is only partly written while it is saved, the
+            # mtimes are not updated so the next poll retries
+            print("Could not read the config, keeping the current targets:", err)
+            return False
+        self._mtimes = self._read_mtimes(new_config.files)
+        try:
+            targets = load_targets(new_config)
+        except (KeyError, ValueError, AttributeError, TypeError) as err:
+            print("Invalid broker targets, keeping the current targets:", err)
+            return False
+        try:
+            self._engine.set_targets(targets)
+        except OSError as err:
+            print("Could not open the broker targets, keeping the current targets:", err)
+            return False
+        print("Reloaded %d broker target(s)" % len(targets))
+        return True
+
+
+if __name__ == "__main__":
+    # load targets
+    targets = load_targets(config.CONFIG)
+
+    if not targets:
+        print("no targets defined")
+        exit(0)
+
+    source = config.CONFIG.get("/broker/source", "localhost:20777")
+    batch_size = config.CONFIG.get("/broker/batchSize", 64)
+    reload_interval = config.CONFIG.get("/broker/reloadInterval", 1.0)
+    capture_file = config.CONFIG.get("/broker/captureFile")
+
+    in_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    in_socket.bind(address_to_target(source))
+
+    capture_writer = None
+    if capture_file:
+        capture_writer = capture.CaptureWriter(capture_file, config.CONFIG.get("/capture/capacity", 65536))
+
+    engine = FanoutEngine(in_socket, targets, batch_size, capture_writer)
+
+    # Targets are reloaded when the config files change or on SIGHUP
+    reloader = TargetReloader(engine, reload_interval)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reloader.request)
+
+    try:
+        engine.run(reloader)
+    except KeyboardInterrupt:
+        pass
+    except Exception as error:
+        print(error)
+        exit(1)
+    finally:
+        print("Forwarded %d packet(s), per target: %s" % (engine.received_count, engine.stats()))
+        in_socket.close()
+        engine.close()
+        if capture_writer is not None:
+            capture_writer.close()
+            print("Capture: %s" % capture_writer.stats())